@@ -2,21 +2,26 @@
 
 import c4d
 import os.path
-import shutil
 from c4d import gui
 
 from espntools import core
 from espntools import scene
+from espntools import store
 from espntools import database
+from espntools import filesystem
+from espntools import textures
 
 # TEAM AUTOMATION #################################################################################
 def assignTeamColors( tricode, location, swap=False ):
-    scene_data    = scene.getSceneData()
-    color_vectors = database.getTeamColors(scene_data['Production'], tricode)
+    color_vectors = database.getTeamColors(scene.MetaScene().production, tricode)
+    location      = location.upper()
 
-    core.changeColor('{0}_PRIMARY'.format(location.upper()), color_vectors['primary'], exact=False)
-    core.changeColor('{0}_SECONDARY'.format(location.upper()), color_vectors['secondary'], exact=False)
-    core.changeColor('{0}_TERTIARY'.format(location.upper()), color_vectors['tertiary'], exact=False)
+    # one pass over the scene materials, one undo step
+    core.assignMaterials({
+        '{0}_PRIMARY'.format(location): {c4d.MATERIAL_COLOR_COLOR: color_vectors['primary']},
+        '{0}_SECONDARY'.format(location): {c4d.MATERIAL_COLOR_COLOR: color_vectors['secondary']},
+        '{0}_TERTIARY'.format(location): {c4d.MATERIAL_COLOR_COLOR: color_vectors['tertiary']}
+        }, exact=False, kind='color')
 
     return True
 
@@ -27,50 +32,50 @@ def sortTagObject( name=None ):
         tags = core.tag(typ=c4d.Tannotation, name=name)
     core.visibility(tags, v=False, r=False)
 
-def relinkTextures( migrate=False ):
+def relinkTextures( migrate=False, store_mode=None ):
     ''' Searches the scene for all referenced textures.  If any texture found already exists in the
         production's main texture repository, it changes the link to the production version instead.
         Optional migrate flag will prompt the user to select which remaining textures they would like
-        moved & relinked to production folders.'''
+        moved & relinked to production folders. Migrated textures are plain copies, unless a
+        store_mode ('copy', 'hardlink' or 'symlink') is passed to keep them in the content store.'''
     doc          = c4d.documents.GetActiveDocument()
-    scn          = scene.Scene()
+    scn          = scene.MetaScene(alert=True)
     doc_tex_dir  = os.path.join(doc.GetDocumentPath(), 'tex')
-    prod_tex_dir = os.path.join(scn.prod_data['assets'], 'TEXTURES')
     # container dictionary of textures that have been relinked
     '''relinked_tex = {}'''
     # container for textures that haven't been checked in yet
     new_tex      = []
-    # Build an array with all textured channels in the scene
-    textures     = core.getSceneTextures()
-    doc.StartUndo()
-    for tex in textures:
+    # All textured shaders in the scene, grouped by path, so each unique texture is checked once
+    texture_refs = textures.summary(textures.scan(doc))
+    # One batched existence check for the scene's own textures, and an in-memory index of the
+    # production & team texture folders
+    found_tex    = filesystem.existing([p for p, refs in texture_refs.iteritems() if refs[0].path])
+    repository   = getTextureRepository(scn.production, scn.prod_data)
+    try:
+        teams    = database.getTeamIndex(scn.production)
+    except IOError:
+        # productions without a team database have no team textures
+        teams    = database.TeamIndex({})
+    core.startUndo(doc)
+    for tex_path, refs in texture_refs.iteritems():
         # Extrapolating texture information
-        shd, tex_path = tex
-        if tex_path == None: continue
-        if not (os.path.isfile(tex_path)): continue
-        tex_dir       = os.path.dirname(tex_path)
+        if not (tex_path in found_tex): continue
         tex_name      = os.path.basename(tex_path)
 
         # split the texture name and see if it contains a team tricode prefix
         tricode_      = tex_name.split('_')[0]
-        is_team_tex   = database.isTricode(scn.production, tricode_)
-        # if it does contain a tricode prefix, we search for the texture in an asset folder instead
-        if (is_team_tex): 
-            team_tex_dir = os.path.join(scn.prod_data['teams'], tricode_, 'tex')
-        else: 
+        is_team_tex   = teams.isTricode(tricode_)
+        # if it does contain a tricode prefix, we search for the texture in the team's asset folder
+        if not (is_team_tex): 
             tricode_ = None
-
-        # Build a texture search path for an existing texture
-        if not (is_team_tex):
-            existing_tex = os.path.join(prod_tex_dir, tex_name)
-        elif (is_team_tex):
-            existing_tex = os.path.join(team_tex_dir, tex_name)
+        existing_tex  = repository.find(tex_name, tricode_)
 
         # If an existing texture is found in the project folders:
-        if (os.path.isfile(existing_tex)):
-            # RELINK THE TEXTURE
-            doc.AddUndo(c4d.UNDOTYPE_CHANGE, shd)
-            shd[c4d.BITMAPSHADER_FILENAME] = str(existing_tex)
+        if (existing_tex):
+            # RELINK THE TEXTURE (on every shader that uses it)
+            for ref in refs:
+                doc.AddUndo(c4d.UNDOTYPE_CHANGE, ref.shader)
+                ref.shader[c4d.BITMAPSHADER_FILENAME] = str(existing_tex)
             # Tag the original for possible deletion
             '''
             if not (tex_path in relinked_tex):
@@ -84,17 +89,28 @@ def relinkTextures( migrate=False ):
         # This list then gets passed to the UI function (the if-statement below) for the user to control
         else:
             new_tex.append((tex_path, tricode_))
-    doc.EndUndo()
+    core.endUndo(doc)
     
     if (migrate) and (len(new_tex) > 0):
         # We pass the list of "new" textures to a UI for users to select which to migrate
-        # This UI will copy the textures into project folders, and re-run this func to link them
-        test = TextureMigrateWindow(set(new_tex))
+        # This UI will copy the textures into project folders, and relink the shaders that used them
+        test = TextureMigrateWindow(set(new_tex), texture_refs, store_mode=store_mode)
         test.Open(dlgtype=c4d.DLG_TYPE_MODAL, defaultw=800, defaulth=50)
 
+def getTextureRepository( production, prod_data ):
+    ''' Gets the texture repository index for a production: its global TEXTURES folder (under the
+    key None) and the tex folder of every team asset folder (under the team's tricode.) '''
+    roots = {None: os.path.join(prod_data['assets'], 'TEXTURES')}
+    try:
+        for tricode in filesystem.listSubdirs(prod_data['teams']):
+            roots[tricode] = os.path.join(prod_data['teams'], tricode, 'tex')
+    except OSError:
+        pass
+    return textures.getRepository(production, roots, cache=database.__texturedb__.format(production))
+
 ### UI OBJECTS ###################################################################################
 class TextureMigrateWindow(gui.GeDialog):
-    def __init__(self, texture_list):
+    def __init__(self, texture_list, texture_refs=None, store_mode=None):
         # Texture migration UI values
         self.INSTRUCTIONS = 90000
         self.CHKBOX_START = 10000
@@ -103,6 +119,10 @@ class TextureMigrateWindow(gui.GeDialog):
         self.BUTTON_CANCEL= 20001
 
         self.TEX_DATA = texture_list
+        # {path: [textures.TextureRef]} -- the shaders to relink once their textures are migrated
+        self.TEX_REFS = texture_refs
+        # how migrated textures are materialized from the content store (None: don't use the store)
+        self.STORE_MODE = store_mode
 
         i = self.CHKBOX_START
         for texture_path in texture_list:
@@ -151,16 +171,16 @@ team's asset /tex/ folder.
         if (id==self.BUTTON_OK):
             self.run()
             self.Close()
-            relinkTextures()
         return True
 
     def run(self):
-        ''' Iterates over all selected checkboxes in the UI, copying the checked textures into the correct
-            folder for that production.'''
-        scn = scene.Scene()
+        ''' Migrates all selected checkboxes in the UI into the correct folder for that production, then
+            relinks the shaders that used them.'''
+        scn = scene.MetaScene(alert=True)
         global_texture_path = os.path.join(scn.prod_data['assets'], 'TEXTURES')
         team_texture_path   = scn.prod_data['teams']
 
+        jobs = []
         for i in range(len(self.CHKBOX_DATA)):
             #CHKBOX_DATA (path & tricode) is a parallel array to CHKBOX_START (UIIDs)
             i += self.CHKBOX_START
@@ -170,10 +190,39 @@ team's asset /tex/ folder.
                 # pull the data from the parallel array
                 tex_path, tricode = self.CHKBOX_DATA[i]
                 if not (tricode):
-                    print 'copying', tex_path, 'to ', global_texture_path
-                    shutil.copy2(tex_path, global_texture_path)
+                    jobs.append((tex_path, global_texture_path))
                 elif (tricode):
-                    print 'copying', tex_path, 'to ', tricode, ' folder'
-                    shutil.copy2(tex_path, os.path.join(team_texture_path, tricode, 'tex'))
-
-
+                    jobs.append((tex_path, os.path.join(team_texture_path, tricode, 'tex')))
+
+        def progress(done, total, result):
+            c4d.StatusSetText('Migrating textures ({0}/{1})'.format(done, total))
+            c4d.StatusSetBar(int(100.0 * done / total))
+
+        try:
+            # with a store mode, textures are kept once in the content store (if it's available)
+            content = store.getStore(self.STORE_MODE) if (self.STORE_MODE) else None
+            results = textures.migrate(jobs, progress=progress, store=content)
+        finally:
+            c4d.StatusClear()
+        # the copied textures are picked up by the next relink
+        textures.invalidateRepository(scn.production)
+
+        if (self.TEX_REFS == None):
+            return relinkTextures()
+        return relinkMigrated(results, self.TEX_REFS)
+
+def relinkMigrated( results, texture_refs ):
+    ''' Relinks only the shaders whose textures were migrated.
+    results (list): textures.MigrationResult, from textures.migrate
+    texture_refs (dict): {path: [textures.TextureRef]}, from textures.summary '''
+    doc     = c4d.documents.GetActiveDocument()
+    relinked= 0
+    with core.transaction(doc):
+        for result in results:
+            if not (result.ok): continue
+            for ref in texture_refs.get(result.src, []):
+                doc.AddUndo(c4d.UNDOTYPE_CHANGE, ref.shader)
+                ref.shader[c4d.BITMAPSHADER_FILENAME] = str(result.dst)
+                relinked += 1
+        core.eventAdd()
+    return relinked
@@ -0,0 +1,418 @@
+# coding: UTF-8
+
+# Scene backups for ESPN Animation projects pipeline
+#    - Backups of a scene are saved into the project's backup folder as name.c4d, then
+#      name.0001.c4d, name.0002.c4d, etc.
+#    - The backup folder is listed once and cached; the cache is kept up to date after each save, and
+#      only listed again when something else changes the folder.
+#    - Old backups are thinned out by a retention policy, configured per production (see
+#      RETENTION_POLICY), after each save or in a batch sweep over every project.
+#    - A scene is only serialized once per save: the backup is a copy of the saved file, made on a
+#      background thread. Backups are copies rather than hard links, as a hard link would change
+#      along with the scene file the next time it's saved.
+
+import errno
+import os
+import os.path
+import re
+import threading
+import time
+import zipfile
+import Queue
+# custom libraries
+from espntools import database
+from espntools import debug
+from espntools import filesystem
+
+# name(.####).ext -- the version is optional (the first backup of a scene has none)
+BACKUP_PATTERN = re.compile(r'^(?P<name>.+?)(?:\.(?P<version>\d{4,}))?\.(?P<ext>[^.]+)$')
+PADDING        = 4
+ARCHIVE_FOLDER = 'archive'
+# seconds a save waits for the previous backup of the scene to finish copying
+WAIT_TIMEOUT   = 30.0
+
+# Default backup retention. A production overrides any of these with a 'backup_retention' record.
+#    enabled: run after every save (sweeps can be run on any production)
+#    keep_last: the newest backups of a scene that are always kept
+#    hourly: for this many hours, keep the newest backup in each hour
+#    daily: for this many days, keep the newest backup in each day
+#    archive: older backups are moved into a zip in the backup/archive folder instead of deleted
+RETENTION_POLICY = {
+    'enabled': False,
+    'keep_last': 20,
+    'hourly': 48,
+    'daily': 30,
+    'archive': True
+    }
+
+class BackupIndex(object):
+    ''' The versions of every scene in one backup folder, from a single listing.
+    versions: {(name, ext): set of versions}, where version 0 is the un-numbered first backup.
+    Versions reserved for copies that are still being made are kept apart from the listing, so they
+    aren't lost when the folder is listed again. '''
+    def __init__(self, folder):
+        self.folder   = folder
+        self.versions = {}
+        self.mtime    = None
+        self.exists   = False
+        self._pending = {}
+        self._lock    = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        ''' Lists the backup folder again. '''
+        with self._lock:
+            self.mtime    = filesystem.getMtime(self.folder)
+            self.exists   = not (self.mtime == None)
+            self.versions = {}
+            if not (self.exists):
+                return
+            try:
+                entries = filesystem.listDir(self.folder)
+            except OSError:
+                return
+            for name, is_dir in entries:
+                if not (is_dir):
+                    self._add(name)
+
+    def validate(self):
+        ''' Re-lists the folder if anything else has changed it since it was indexed. '''
+        if not (filesystem.getMtime(self.folder) == self.mtime):
+            self.refresh()
+
+    @staticmethod
+    def parse(file_name):
+        ''' Returns (name, version, ext) for a backup file name, or None. '''
+        match = BACKUP_PATTERN.match(file_name)
+        if (match == None):
+            return None
+        version = match.group('version')
+        return (match.group('name'), int(version) if (version) else 0, match.group('ext'))
+
+    def path(self, name, version, ext):
+        ''' Returns the path of one backup version of a scene (version 0 is name.ext.) '''
+        if (version == 0):
+            return os.path.join(self.folder, '{0}.{1}'.format(name, ext))
+        return os.path.join(self.folder, '{0}.{1}.{2}'.format(name, str(version).zfill(PADDING), ext))
+
+    def _add(self, file_name):
+        parsed = self.parse(file_name)
+        if (parsed):
+            name, version, ext = parsed
+            self.versions.setdefault((name.lower(), ext.lower()), set()).add(version)
+
+    def _taken(self, key):
+        ''' Private. The versions of a scene that are either on disk or reserved. '''
+        return self.versions.get(key, set()) | self._pending.get(key, set())
+
+    def latest(self, file_name):
+        ''' Returns the highest backup version of a scene, including versions reserved for copies that
+        are still being made (-1 if it has never been backed up.) '''
+        name, ext = os.path.splitext(file_name)
+        with self._lock:
+            versions = self._taken((name.lower(), ext[1:].lower()))
+            return max(versions) if (versions) else -1
+
+    def next(self, file_name):
+        ''' Returns the path of the next free backup of a scene file name. Backups are never
+        overwritten: the first is saved as name.c4d, and every following one as the highest existing
+        version + 1. '''
+        name, ext = os.path.splitext(file_name)
+        return self.path(name, self.latest(file_name) + 1, ext[1:])
+
+    def reserve(self, path):
+        ''' Reserves a backup path for a copy. If that version is already taken (indexed, reserved by
+        another copy, or found on disk) the next free version is reserved instead. The reservation
+        lasts until release() is called, whenever the folder is listed again.
+        Returns: the path reserved. '''
+        parsed = self.parse(os.path.basename(path))
+        if (parsed == None):
+            raise ValueError('Not a backup file name: {0}'.format(path))
+        name, version, ext = parsed
+        key = (name.lower(), ext.lower())
+        with self._lock:
+            taken = self._taken(key)
+            if (version in taken):
+                version = max(taken) + 1
+            # another workstation may have saved backups since the folder was listed
+            while os.path.exists(self.path(name, version, ext)):
+                version += 1
+            self._pending.setdefault(key, set()).add(version)
+        return self.path(name, version, ext)
+
+    def release(self, path, saved=True):
+        ''' Ends the reservation of a backup path (see reserve.) If the backup was saved, it's added
+        to the index. '''
+        parsed = self.parse(os.path.basename(path))
+        if (parsed == None):
+            return
+        name, version, ext = parsed
+        with self._lock:
+            self._pending.get((name.lower(), ext.lower()), set()).discard(version)
+            if (saved):
+                self._add(os.path.basename(path))
+                # our own save changed the folder's mtime -- this shouldn't trigger a re-listing
+                self.mtime  = filesystem.getMtime(self.folder)
+                self.exists = not (self.mtime == None)
+
+_indexes = {}
+_index_lock = threading.Lock()
+
+def getIndex( folder ):
+    ''' Gets the (cached) backup index of a folder, validated against the folder's mtime. '''
+    key = os.path.normcase(os.path.abspath(folder))
+    with _index_lock:
+        index = _indexes.get(key)
+        if (index == None):
+            _indexes[key] = index = BackupIndex(folder)
+            return index
+    index.validate()
+    return index
+
+def nextBackup( folder, file_name ):
+    ''' Returns the path of the next backup of a scene in a backup folder. '''
+    return getIndex(folder).next(file_name)
+
+# BACKGROUND COPIES ###############################################################################
+class BackupJob(object):
+    ''' One backup copy. status is 'pending', 'done' or 'failed' (with the exception in error.) '''
+    def __init__(self, src, dst):
+        self.src     = src
+        self.dst     = dst
+        self.status  = 'pending'
+        self.error   = None
+        self.size    = 0
+        self.seconds = 0.0
+        self.index   = None
+        self.policy  = None
+        self._done   = threading.Event()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+class BackupWorker(object):
+    ''' Copies saved scenes into their backup folders, in order, on a single daemon thread. '''
+    def __init__(self):
+        self.jobs    = []
+        self._lock   = threading.Lock()
+        self._queue  = Queue.Queue()
+        self._thread = None
+
+    def submit(self, src, dst, index=None, policy=None):
+        ''' Queues a copy of src to dst, and returns its BackupJob. An existing dst is never
+        overwritten. With a BackupIndex, dst has to be reserved in it (see BackupIndex.reserve): if
+        another copy saved dst first, the next free version is used instead; the reservation is
+        released once the copy is made (or fails.) The retention policy (if any) is then applied to
+        that scene's backups. '''
+        job = BackupJob(src, dst)
+        job.index  = index
+        job.policy = policy
+        with self._lock:
+            # only the most recent finished jobs are kept for reporting
+            finished  = [j for j in self.jobs if not (j.status == 'pending')][-20:]
+            self.jobs = [j for j in self.jobs if (j.status == 'pending') or (j in finished)]
+            self.jobs.append(job)
+            if (self._thread == None) or not (self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run, name='BackupWorker')
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put(job)
+        return job
+
+    def pending(self, src=None):
+        ''' Returns the unfinished jobs (of one source file, or all of them.) '''
+        with self._lock:
+            return [j for j in self.jobs if (j.status == 'pending') and ((src == None) or (j.src == src))]
+
+    def wait(self, src=None, timeout=None):
+        ''' Waits for the pending copies of a file (or all of them) to finish. Returns False if the
+        timeout (for all of them together) expired first. '''
+        deadline = (time.time() + timeout) if (timeout != None) else None
+        for job in self.pending(src):
+            remaining = (max(0.0, deadline - time.time())) if (deadline != None) else None
+            if not job.wait(remaining):
+                return False
+        return True
+
+    def _run(self):
+        while True:
+            job   = self._queue.get()
+            start = time.time()
+            try:
+                job.size   = self._copy(job)
+                job.status = 'done'
+                debug.info('Backup saved', job.dst)
+            except Exception as e:
+                # any error fails this job only -- the worker has to keep running, and waiting saves
+                # have to be released
+                job.error  = e
+                job.status = 'failed'
+                debug.warning('Backup failed', '{0} ({1})'.format(job.dst, e))
+            finally:
+                if (job.index):
+                    job.index.release(job.dst, saved=(job.status == 'done'))
+                job.seconds = time.time() - start
+                job._done.set()
+            # retention runs once the backup is safely made, and its errors don't fail the backup
+            if (job.status == 'done') and (job.policy) and (job.policy['enabled']):
+                try:
+                    retain(os.path.dirname(job.dst), os.path.basename(job.src), policy=job.policy)
+                except Exception as e:
+                    debug.warning('Backup retention failed', '{0} ({1})'.format(os.path.dirname(job.dst), e))
+
+    def _copy(self, job):
+        ''' Private. Copies a job's file without overwriting an existing backup: if its version was
+        saved by someone else in the meantime, the next free version is reserved and used. '''
+        while True:
+            try:
+                return filesystem.copyFile(job.src, job.dst, overwrite=False)
+            except OSError as e:
+                if not (e.errno == errno.EEXIST) or (job.index == None):
+                    raise
+                debug.warning('Backup version already exists, using the next one', job.dst)
+                taken   = job.dst
+                job.dst = job.index.reserve(taken)
+                job.index.release(taken, saved=True)
+
+_worker = BackupWorker()
+
+def copyBackup( src, dst, background=True, policy=None ):
+    ''' Backs up a saved scene file to dst, or to the next free version if dst is taken (existing
+    backups are never overwritten.) With background, the copy is made on the backup worker and its
+    BackupJob is returned straight away. An enabled retention policy is applied to the
+    scene's backups after the copy. '''
+    index = getIndex(os.path.dirname(dst))
+    # reserve the version straight away, so the next save can't pick the same name (the job's dst is
+    # the next free version if dst is already taken)
+    job = _worker.submit(src, index.reserve(dst), index, policy)
+    if not (background):
+        job.wait()
+    return job
+
+def wait( src=None, timeout=None ):
+    ''' Waits for pending backup copies (of one scene file, or all of them.) '''
+    return _worker.wait(src, timeout)
+
+def status():
+    ''' Returns the recent backup jobs, newest last. '''
+    with _worker._lock:
+        return list(_worker.jobs)
+
+# RETENTION #######################################################################################
+def getPolicy( prod_data=None ):
+    ''' Returns the retention policy of a production record (the defaults, with any overrides.) '''
+    policy = dict(RETENTION_POLICY)
+    if (prod_data):
+        policy.update(prod_data.get('backup_retention', {}))
+    policy['keep_last'] = max(1, int(policy['keep_last']))
+    return policy
+
+def plan( backups, policy, now=None ):
+    ''' Decides which backups of one scene to keep. The newest backup is always kept, so version
+    numbers keep increasing.
+    backups (list): (version, path, size, mtime)
+    Returns: (keep, expire) lists of the same tuples, newest first. '''
+    if (now == None):
+        now = time.time()
+    backups = sorted(backups, reverse=True)
+    keep    = backups[:policy['keep_last']]
+    expire  = []
+    # the hours / days already covered by the backups kept as the newest
+    buckets = set(_bucket(entry[3], now, policy) for entry in keep)
+    for entry in backups[policy['keep_last']:]:
+        bucket = _bucket(entry[3], now, policy)
+        # the newest backup in each hour / day is kept
+        if (bucket) and not (bucket in buckets):
+            buckets.add(bucket)
+            keep.append(entry)
+        else:
+            expire.append(entry)
+    return (keep, expire)
+
+def _bucket( mtime, now, policy ):
+    ''' Private. The hour or day a backup is kept for (see plan), or None if it's older than both. '''
+    age = now - mtime
+    if (age < policy['hourly'] * 3600):
+        return ('hour', int(mtime // 3600))
+    elif (age < policy['daily'] * 86400):
+        return ('day', time.localtime(mtime)[:3])
+    return None
+
+def retain( folder, file_name=None, policy=None, dry_run=False, now=None ):
+    ''' Applies a retention policy to the backups in one folder (of one scene, or of every scene.)
+    Expired backups are archived or deleted; with dry_run, nothing is changed.
+    Returns: {'kept': int, 'expired': [paths], 'bytes': bytes reclaimed from the backup folder} '''
+    if (policy == None):
+        policy = getPolicy()
+    report = {'kept': 0, 'expired': [], 'bytes': 0}
+    try:
+        files = filesystem.listFileStats(folder)
+    except OSError:
+        return report
+
+    scenes = {}
+    names  = {}
+    only   = BackupIndex.parse(file_name) if (file_name) else None
+    for name, size, mtime in files:
+        parsed = BackupIndex.parse(name)
+        if (parsed == None) or not (parsed[2].lower() == 'c4d') or name.endswith('.tmp'):
+            continue
+        key = (parsed[0].lower(), parsed[2].lower())
+        if (only) and not (key == (only[0].lower(), only[2].lower())):
+            continue
+        scenes.setdefault(key, []).append((parsed[1], os.path.join(folder, name), size, mtime))
+        # the scene's name as it's written on its newest backup (for naming its archive)
+        if (parsed[1] >= names.get(key, (-1, None))[0]):
+            names[key] = (parsed[1], parsed[0])
+
+    for key, backups in scenes.iteritems():
+        keep, expire = plan(backups, policy, now)
+        report['kept'] += len(keep)
+        for version, path, size, mtime in expire:
+            report['expired'].append(path)
+            report['bytes'] += size
+        if not (dry_run) and (expire):
+            _expire(folder, names[key][1], [entry[1] for entry in expire], policy)
+
+    if not (dry_run) and (report['expired']):
+        getIndex(folder).refresh()
+        debug.info('Expired backups', '{0} ({1} files, {2:.1f} MB)'.format(
+            folder, len(report['expired']), report['bytes'] / (1024.0 * 1024.0)))
+    return report
+
+def _expire( folder, name, paths, policy ):
+    ''' Private. Archives (or deletes) expired backups of one scene. '''
+    if (policy['archive']):
+        archive_folder = os.path.join(folder, ARCHIVE_FOLDER)
+        if not os.path.isdir(archive_folder):
+            os.makedirs(archive_folder)
+        archive_path = os.path.join(archive_folder, name + '.zip')
+        with zipfile.ZipFile(archive_path, 'a', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            archived = set(archive.namelist())
+            for path in paths:
+                if not (os.path.basename(path) in archived):
+                    archive.write(path, os.path.basename(path))
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError as e:
+            debug.warning('Could not remove backup', '{0} ({1})'.format(path, e))
+
+def sweep( prod_, dry_run=True, now=None ):
+    ''' Applies a production's retention policy to the backup folder of every one of its projects.
+    Defaults to a dry run, reporting what would be reclaimed.
+    Returns: {'folders': int, 'kept': int, 'expired': [paths], 'bytes': int} '''
+    prod_data = database.getProduction(prod_)
+    policy    = getPolicy(prod_data)
+    total     = {'folders': 0, 'kept': 0, 'expired': [], 'bytes': 0}
+    for project in database.getAllProjects(prod_):
+        folder = prod_data['folder_lookup']['c4d_backup'].format(project)
+        report = retain(folder, policy=policy, dry_run=dry_run, now=now)
+        total['folders'] += 1
+        total['kept']    += report['kept']
+        total['expired'] += report['expired']
+        total['bytes']   += report['bytes']
+    debug.info('Backup sweep{0}'.format(' (dry run)' if (dry_run) else ''), '{0} : {1} backups, {2:.1f} MB reclaimed'.format(
+        prod_, len(total['expired']), total['bytes'] / (1024.0 * 1024.0)))
+    return total
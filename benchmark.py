@@ -0,0 +1,357 @@
+# coding: UTF-8
+
+# Benchmarks for ESPN Animation projects pipeline
+#    - Run these from the C4D script manager / console, e.g.:
+#        from espntools import benchmark; benchmark.snapshotLoad()
+#    - Each benchmark builds its own synthetic data, reports through debug.info and returns its
+#      timings as a dictionary.
+
+import json
+import os.path
+import shutil
+import tempfile
+import time
+# c4d libraries
+import c4d
+# custom libraries
+from espntools import core
+from espntools import database
+from espntools import debug
+from espntools import filesystem
+from espntools import scene
+from espntools import symbols
+from espntools import traverse
+
+def _timeit(func, runs):
+    ''' Returns the best wall-clock time (in seconds) of several runs of func. '''
+    best = None
+    for i in range(runs):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if (best == None) or (elapsed < best):
+            best = elapsed
+    return best
+
+class _StandIn(object):
+    ''' A minimal stand-in for a BaseObject / BaseTag, so that hierarchy benchmarks can build
+    hundreds of thousands of nodes without a document. '''
+    __slots__ = ('name', 'up', 'down', 'next', 'pred', 'tag')
+
+    def __init__(self, name):
+        self.name = name
+        self.up = self.down = self.next = self.pred = self.tag = None
+
+    def GetName(self):       return self.name
+    def GetUp(self):         return self.up
+    def GetDown(self):       return self.down
+    def GetNext(self):       return self.next
+    def GetPred(self):       return self.pred
+    def GetFirstTag(self):   return self.tag
+    def GetRenderMode(self): return c4d.MODE_UNDEF
+    def GetDocument(self):   return None
+    def GetType(self):       return c4d.Tannotation
+
+def _buildHierarchy(depth, width):
+    ''' Builds a stand-in hierarchy: a spine of the given depth, where every node on the spine has
+    (width - 1) leaf siblings. Returns the first node. '''
+    first = parent = None
+    count = 0
+    for d in range(depth):
+        prev = None
+        for w in range(width):
+            node = _StandIn('node_{0}_{1}'.format(d, w))
+            node.up, node.pred = parent, prev
+            if (prev): prev.next = node
+            elif (parent): parent.down = node
+            else: first = node
+            prev = node
+            count += 1
+        # the spine continues from the first node of each level
+        parent = parent.down if (parent) else first
+    return first, count
+
+def _legacyIsVisible(obj_):
+    ''' The previous, recursive core.isVisible, kept for comparison. '''
+    if obj_.GetRenderMode() == c4d.MODE_OFF:
+        return False
+    for tag in core.TagIterator(obj_):
+        if tag.GetType() == c4d.Tcompositing:
+            if tag[c4d.COMPOSITINGTAG_MATTEOBJECT] == 1:
+                return False
+            elif tag[c4d.COMPOSITINGTAG_SEENBYCAMERA] == 0:
+                return False
+    parent = obj_.GetUp()
+    while parent:
+        if not _legacyIsVisible(parent):
+            return False
+        else:
+            parent = parent.GetUp()
+    return True
+
+def _buildDatabase(root, productions=50, teams=3000):
+    ''' Writes a synthetic productions.json (with platform and team databases) into root. The teams
+    are split evenly across the productions.  Returns the path to productions.json. '''
+    per_prod = max(1, teams / productions)
+    full_db  = {
+        'NULL': {},
+        'ESPN_META': {},
+        'FOLDER_TEMPLATE': {'PROJECT': {'c4d': ['backup', 'tex'], 'render_3d': [], 'ae': []}},
+        'DEFAULT': {
+            'json': {
+                'c4d': os.path.join(root, 'PROD_000_c4d.json'),
+                'teams': os.path.join(root, 'PROD_000_teams.json')
+                },
+            'assets': os.path.join(root, 'assets'),
+            'teams': os.path.join(root, 'teams'),
+            'folder_lookup': {
+                'animroot': os.path.join(root, 'anim'),
+                'c4d_project': os.path.join(root, 'anim', '{0}', 'c4d'),
+                'c4d_backup': os.path.join(root, 'anim', '{0}', 'c4d', 'backup'),
+                'render_3d': os.path.join(root, 'anim', '{0}', 'render_3d')
+                }
+            }
+        }
+    for p in range(productions):
+        prod_   = 'PROD_{0:03d}'.format(p)
+        c4d_db  = os.path.join(root, '{0}_c4d.json'.format(prod_))
+        team_db = os.path.join(root, '{0}_teams.json'.format(prod_))
+        full_db[prod_] = {
+            'json': {'c4d': c4d_db, 'teams': team_db},
+            'folder_lookup': {'animroot': os.path.join(root, 'anim', prod_)}
+            }
+        with open(c4d_db, 'w') as stream:
+            json.dump({'presets': ['preset_{0:02d}'.format(i) for i in range(20)]}, stream)
+        with open(team_db, 'w') as stream:
+            json.dump(dict(
+                ('T{0:02d}{1:03d}'.format(p, t), {
+                    'city': 'City {0}'.format(t),
+                    'nick': 'Nick {0}'.format(t),
+                    'PRIMARY': 'FF0000',
+                    'SECONDARY': '00FF00',
+                    'TERTIARY': '0000FF'
+                    }) for t in range(per_prod)), stream)
+
+    global_db = os.path.join(root, 'productions.json')
+    with open(global_db, 'w') as stream:
+        json.dump(full_db, stream)
+    return global_db
+
+def snapshotLoad(productions=50, teams=3000, runs=5):
+    ''' Cold-start load time of every production record, preset list and team database, parsed from
+    JSON versus loaded from a compiled snapshot. '''
+    root   = tempfile.mkdtemp(prefix='espn_bench_')
+    saved  = (database.__globaldb__, database.__snapshotdb__, database._cache)
+    try:
+        database.__globaldb__   = _buildDatabase(root, productions, teams)
+        database.__snapshotdb__ = os.path.join(root, 'productions.snapshot')
+
+        def cold_load(snapshot):
+            database._cache = database.JsonCache(snapshot=snapshot)
+            database._resolved.clear()
+            for prod_ in database.getAllProductions():
+                database.getProduction(prod_)
+                database.getAllPresets(prod_)
+                database.getTeamDatabase(prod_)
+
+        database._cache = database.JsonCache()
+        database.compileSnapshot()
+        results = {
+            'json': _timeit(lambda: cold_load(None), runs),
+            'snapshot': _timeit(lambda: cold_load(database.Snapshot()), runs)
+            }
+    finally:
+        database.__globaldb__, database.__snapshotdb__, database._cache = saved
+        database._resolved.clear()
+        shutil.rmtree(root, ignore_errors=True)
+
+    debug.info('Cold database load ({0} productions / {1} teams)'.format(productions, teams),
+        'json {0:.1f} ms, snapshot {1:.1f} ms'.format(results['json']*1000, results['snapshot']*1000))
+    return results
+
+def backendLatency(productions=50, teams=3000, calls=200):
+    ''' Per-call latency of single-team questions (getTeam / isTricode) through the JSON backend and
+    the SQLite backend. "cold" drops every cache before each call (the cost of a one-off question);
+    "warm" repeats the call against populated caches. '''
+    root   = tempfile.mkdtemp(prefix='espn_bench_')
+    saved  = (database.__globaldb__, database.__sqlitedb__, database._cache, database._backend)
+    results= {}
+    try:
+        database.__globaldb__ = _buildDatabase(root, productions, teams)
+        database.__sqlitedb__ = os.path.join(root, 'productions.sqlite')
+        database._cache       = database.JsonCache()
+        database.setBackend('json')
+        database.importToSqlite()
+        prods = database.getAllProductions()[1:]
+        picks = [(p, database.getAllTeams(p)[i % 10]) for i, p in enumerate(prods)]
+
+        for name in ('json', 'sqlite'):
+            # one backend (and connection) per run; "cold" only drops its caches
+            backend = database.setBackend(name)
+            def lookup(cold):
+                for prod_, tricode in picks:
+                    if (cold):
+                        database._cache = database.JsonCache()
+                        backend.clear()
+                    database.getTeam(prod_, tricode)
+                    database.isTricode(prod_, 'XXX')
+            results[name] = {
+                'cold': _timeit(lambda: lookup(True), 1) / (len(picks) * 2),
+                'warm': _timeit(lambda: [lookup(False) for i in range(calls / len(picks) or 1)], 1) /
+                    ((calls / len(picks) or 1) * len(picks) * 2)
+                }
+    finally:
+        database.getBackend().close()
+        database.__globaldb__, database.__sqlitedb__, database._cache, database._backend = saved
+        database._resolved.clear()
+        shutil.rmtree(root, ignore_errors=True)
+
+    for name in ('json', 'sqlite'):
+        debug.info('Team lookup latency ({0} backend)'.format(name),
+            'cold {0:.3f} ms/call, warm {1:.3f} ms/call'.format(
+                results[name]['cold']*1000, results[name]['warm']*1000))
+    return results
+
+def projectListing(projects=2000):
+    ''' Server round trips needed to list a production's projects: the previous listdir + isdir per
+    entry, against the cached listing used by database.getAllProjects (made with scandir where it's
+    available -- not under C4D's Python 2.7 unless the scandir package is installed.) '''
+    root = tempfile.mkdtemp(prefix='espn_bench_')
+    try:
+        for p in range(projects):
+            os.mkdir(os.path.join(root, 'PROJECT_{0:04d}'.format(p)))
+            open(os.path.join(root, 'file_{0:04d}.txt'.format(p)), 'w').close()
+
+        # the previous implementation: one listing plus one stat per entry
+        legacy_calls = 1
+        for d in os.listdir(root):
+            os.path.isdir(os.path.join(root, d))
+            legacy_calls += 1
+
+        cache = filesystem.DirectoryCache(ttl=60.0)
+        filesystem.resetCounters()
+        cache.get(root)
+        first = filesystem.getCounters()
+        cache.get(root)
+        second = filesystem.getCounters()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    results = {
+        'mode': 'scandir' if (filesystem.scandir) else 'listdir fallback',
+        'legacy': legacy_calls,
+        'first': sum(first.values()),
+        'cached': sum(second.values()) - sum(first.values())
+        }
+    debug.info('Project listing round trips ({0} projects)'.format(projects),
+        'listdir+isdir {legacy}, {mode} {first}, cached {cached}'.format(**results))
+    return results
+
+def visibility(depth=16, width=4, runs=3):
+    ''' Resolving the visibility of every object in a deep stand-in hierarchy: calling the previous
+    recursive isVisible per object, against the single top-down pass used by object buffers. The
+    recursive version re-checks each parent once per path to it, so keep the depth modest. '''
+    first, count = _buildHierarchy(depth, width)
+    results = {
+        'objects': count,
+        'recursive': _timeit(lambda: [_legacyIsVisible(o) for o in core.ObjectIterator(first)], runs),
+        'single_pass': _timeit(lambda: core.resolveVisibility(first), runs)
+        }
+    debug.info('Visibility of {0} objects, depth {1}'.format(count, depth),
+        'recursive {0:.1f} ms, single pass {1:.1f} ms'.format(
+            results['recursive']*1000, results['single_pass']*1000))
+    return results
+
+def _buildWideHierarchy(nodes, fanout=8):
+    ''' Builds a stand-in hierarchy of roughly the given number of nodes, where every node has up to
+    fanout children, each carrying one tag. Returns the first node. '''
+    first = _StandIn('node_0')
+    queue = [first]
+    count = 1
+    i = 0
+    while (count < nodes):
+        parent = queue[i]
+        i += 1
+        prev = None
+        for f in range(min(fanout, nodes - count)):
+            node = _StandIn('node_{0}'.format(count))
+            node.tag = _StandIn('tag_{0}'.format(count))
+            node.up, node.pred = parent, prev
+            if (prev): prev.next = node
+            else: parent.down = node
+            prev = node
+            queue.append(node)
+            count += 1
+    return first
+
+def traversal(nodes=200000, runs=3):
+    ''' Walking a 200k node stand-in hierarchy with core.ObjectIterator (+ TagIterator) against the
+    traverse generators. '''
+    first = _buildWideHierarchy(nodes)
+
+    def legacy_tags():
+        for o in core.ObjectIterator(first):
+            for t in core.TagIterator(o):
+                pass
+
+    def fused_tags():
+        for o, parent, depth, tags in traverse.objectsWithTags(first):
+            pass
+
+    results = {
+        'iterator': _timeit(lambda: [o for o in core.ObjectIterator(first)], runs),
+        'generator': _timeit(lambda: [o for o in traverse.objects(first)], runs),
+        'iterator_tags': _timeit(legacy_tags, runs),
+        'generator_tags': _timeit(fused_tags, runs)
+        }
+    debug.info('Traversal of {0} nodes'.format(nodes),
+        'ObjectIterator {0:.0f} ms, traverse.objects {1:.0f} ms'.format(
+            results['iterator']*1000, results['generator']*1000))
+    debug.info('Traversal of {0} nodes with tags'.format(nodes),
+        'ObjectIterator+TagIterator {0:.0f} ms, traverse.objectsWithTags {1:.0f} ms'.format(
+            results['iterator_tags']*1000, results['generator_tags']*1000))
+    return results
+
+class _StandInTag(_StandIn):
+    ''' A stand-in compositing tag, with parameters. '''
+    __slots__ = ('data',)
+
+    def __init__(self, name, data):
+        _StandIn.__init__(self, name)
+        self.data = data
+
+    def __getitem__(self, key): return self.data.get(key, 0)
+    def GetType(self):          return c4d.Tcompositing
+
+def _legacyObjectBufferIDs(start):
+    ''' The previous scene._getObjectBufferIDs, which eval()s each channel name, kept for comparison. '''
+    ids = []
+    channel_enable = 'c4d.COMPOSITINGTAG_ENABLECHN{}'
+    channel_id     = 'c4d.COMPOSITINGTAG_IDCHN{}'
+    for obj, visible in core.walkVisibility(start):
+        if (visible):
+            for tag in core.TagIterator(obj):
+                if tag.GetType() == c4d.Tcompositing:
+                    for i in range(12):
+                        if tag[eval(channel_enable.format(i))] == 1:
+                            id_ = tag[eval(channel_id.format(i))]
+                            ids.append(id_)
+    return sorted(list(set(ids)), reverse=True)
+
+def objectBufferDiscovery(nodes=5000, runs=3):
+    ''' Finding the object buffer ids of a stand-in scene where every object has a compositing tag:
+    eval()ing the channel names per tag, against the precomputed symbols tables. '''
+    first = _buildWideHierarchy(nodes)
+    for i, obj in enumerate(traverse.objects(first)):
+        enable, id_ = symbols.COMPOSITINGTAG_CHANNELS[i % 12]
+        obj.tag = _StandInTag('tag_{0}'.format(i), {enable: 1, id_: i % 40, c4d.COMPOSITINGTAG_SEENBYCAMERA: 1})
+
+    results = {
+        'objects': nodes,
+        'eval': _timeit(lambda: _legacyObjectBufferIDs(first), runs),
+        'symbols': _timeit(lambda: scene._getObjectBufferIDs(first), runs)
+        }
+    debug.info('Object buffer discovery over {0} tagged objects'.format(nodes),
+        'eval {0:.0f} ms, symbol tables {1:.0f} ms'.format(
+            results['eval']*1000, results['symbols']*1000))
+    return results
@@ -2,13 +2,18 @@
 
 #    Core wrapper for Cinema 4d Python API
 #    - This wraps C4D functionality of a broad range of object operations with common conditionals
-#      and error handling.  These functions have no other dependencies besides Maxon's c4d module.
+#      and error handling.  Besides Maxon's c4d module, these functions use the pipeline's traversal,
+#      symbol and texture scanning helpers (which also depend only on c4d and the other helpers.)
 
 import os.path
 # internal libraries
 import c4d
 from c4d import gui
 from c4d.modules import render
+# custom libraries
+from espntools import symbols
+from espntools import textures
+from espntools import traverse
 
 OVERRIDE_GROUPS = [
     #'bty',
@@ -70,10 +75,158 @@ def merge( file_=None ):
         c4d.CallCommand(12096, 12096)
     return
 
-def lookupID( id ):
-    for k in c4d.__dict__.keys():
-        if c4d.__dict__[k] == id:
-            print k
+def transaction( doc_=None ):
+    ''' Returns a Transaction for the active (or passed) document. Usage:
+        with core.transaction() as t:
+            core.take('shadows')
+            core.setOutputFiletype('exr')
+        print t.events  # the number of scene updates coalesced into one '''
+    return Transaction(doc_)
+
+def lookupID( id, prefix='' ):
+    ''' Prints (and returns) the names of every c4d constant with the passed value. '''
+    names = symbols.names(id, prefix)
+    for k in names:
+        print k
+    return names
+
+# TRANSACTIONS ####################################################################################
+class Transaction(object):
+    ''' A re-entrant context for batching core operations. Inside a transaction, the helpers in this
+    module join one undo group (opened and closed by the outermost transaction), and their scene
+    updates are queued and fired as a single c4d.EventAdd() when the outermost transaction exits.
+    After exiting, 'events' holds the number of scene updates that were coalesced. '''
+    _depth  = 0
+    _doc    = None
+    _events = 0
+
+    def __init__(self, doc_=None):
+        self.doc    = doc_
+        self.events = 0
+
+    def __enter__(self):
+        if (Transaction._depth == 0):
+            Transaction._doc    = self.doc or doc()
+            Transaction._events = 0
+            Transaction._doc.StartUndo()
+        Transaction._depth += 1
+        self._start = Transaction._events
+        return self
+
+    def __exit__(self, *exc):
+        Transaction._depth -= 1
+        self.events = Transaction._events - self._start
+        if (Transaction._depth == 0):
+            Transaction._doc.EndUndo()
+            Transaction._doc = None
+            if (self.events):
+                c4d.EventAdd()
+        return False
+
+    @staticmethod
+    def active():
+        return Transaction._depth > 0
+
+def startUndo( doc_ ):
+    ''' Opens an undo group, unless a transaction already has one open. '''
+    if not Transaction.active():
+        doc_.StartUndo()
+
+def endUndo( doc_ ):
+    ''' Closes an undo group, unless it belongs to an open transaction. '''
+    if not Transaction.active():
+        doc_.EndUndo()
+
+def eventAdd():
+    ''' Requests a scene update -- immediately, or deferred until the open transaction exits. '''
+    if Transaction.active():
+        Transaction._events += 1
+    else:
+        c4d.EventAdd()
+
+# DOCUMENT INDEX ##################################################################################
+class DocumentIndex(object):
+    ''' Name and tag lookups for a document, built in a single traversal of its object hierarchy.
+    Use getIndex() rather than building one directly -- it caches the index per document and
+    rebuilds it when the document's dirty count changes. '''
+    def __init__(self, doc):
+        self.doc       = doc
+        self.dirty     = _dirtyCount(doc)
+        # whether the index has been built since its last lookup, and the lookups that have already
+        # come up empty against it (see _lookup)
+        self.fresh     = True
+        self.misses    = set()
+        self.names     = {}
+        self.tag_types = {}
+        self.tag_names = {}
+        for obj, parent, depth, tags in traverse.objectsWithTags(doc.GetFirstObject()):
+            self.names.setdefault(obj.GetName(), []).append(obj)
+            for tag in tags:
+                self.tag_types.setdefault(tag.GetType(), []).append(tag)
+                self.tag_names.setdefault(tag.GetName(), []).append(tag)
+
+    def objects(self, name):
+        ''' Returns a list of all objects with the given name. '''
+        return list(self.names.get(name, []))
+
+    def tags(self, name=None, typ=None):
+        ''' Returns a list of all tags matching the given name and/or type. '''
+        if (name == None):
+            return list(self.tag_types.get(typ, []))
+        tags = self.tag_names.get(name, [])
+        if (typ == None):
+            return list(tags)
+        return [t for t in tags if t.GetType() == typ]
+
+    def is_valid(self, doc):
+        return (self.doc == doc) and (self.dirty == _dirtyCount(doc))
+
+_indexes = []
+
+def _dirtyCount(doc):
+    return doc.GetDirty(c4d.DIRTYFLAGS_DATA | c4d.DIRTYFLAGS_CHILDREN)
+
+def getIndex( doc_=None, rebuild=False ):
+    ''' Returns the (cached) DocumentIndex of the active document, or of the passed document. '''
+    if not (doc_):
+        doc_ = doc()
+    for idx in _indexes:
+        if (idx.doc == doc_):
+            if (rebuild) or not (idx.is_valid(doc_)):
+                _indexes.remove(idx)
+                break
+            return idx
+    # drop indexes of documents that have since been closed
+    _indexes[:] = [i for i in _indexes if i.doc.IsAlive()]
+    idx = DocumentIndex(doc_)
+    _indexes.append(idx)
+    return idx
+
+def _lookup( key, find, current ):
+    ''' Private. Runs a lookup against the active document's index. The index is rebuilt (at most
+    once) when a hit is stale -- deleted or renamed since the index was built -- or when nothing is
+    found, since objects & tags the user just added don't always change the document's dirty count.
+    A lookup that still finds nothing isn't rescanned for again until the document changes.
+    key: identifies the lookup; find: function(DocumentIndex) returning a list; current:
+    function(hit) returning bool. '''
+    idx    = getIndex()
+    found  = find(idx)
+    if (found):
+        stale = not all(current(hit) for hit in found)
+    else:
+        stale = not (key in idx.misses)
+    if (stale) and not (idx.fresh):
+        idx   = getIndex(rebuild=True)
+        found = find(idx)
+    if not (found):
+        idx.misses.add(key)
+    idx.fresh = False
+    return found
+
+def invalidateIndex( doc_=None ):
+    ''' Drops the cached index of a document (all documents if none is passed.) Call after changing
+    the hierarchy in a way that may not mark the document dirty. '''
+    _indexes[:] = [i for i in _indexes if (doc_) and not (i.doc == doc_)]
 
 # OBJECT-PARSING / SELECTION UTILITIES ############################################################
 def ls( obj=None, typ=c4d.BaseObject, name=None ):
@@ -86,11 +239,8 @@ def ls( obj=None, typ=c4d.BaseObject, name=None ):
     # If a string is passed to name, the command will attempt to locate it by exact name.
     # Since C4D allows objects to have the same name, it will always return a list
     elif (isinstance(name, str)):
-        start = doc().GetFirstObject()
-        obj   = []
-        for o in ObjectIterator(start):
-            if o.GetName() == name:
-                obj.append(o)
+        obj = _lookup(('object', name), lambda idx: idx.objects(name),
+                      lambda o: (o.IsAlive()) and (o.GetName() == name))
 
     # If a passed object is not already a list, we force the recast
     if not (isinstance(obj, list)):
@@ -112,10 +262,13 @@ def lsTags( obj=None, name=None, typ=None ):
     least one must be included in the command. '''
     if (name==None) and (typ==None):
         return
+    # Searching the whole scene goes through the document index
+    if not (obj):
+        return _lookup(('tag', name, typ), lambda idx: idx.tags(name=name, typ=typ),
+                       lambda tag: (tag.IsAlive()) and ((not name) or (tag.GetName() == name)))
+
     return_tags = []
     # If an object reference is passed, search only its heirarchy
-    if not (obj): obj = doc().GetFirstObject()
-
     for o in ObjectIterator(obj):
         # Search each object for tags
         for tag in TagIterator(o):
@@ -138,13 +291,13 @@ def xref( namespace, ref, proxy=None ):
     op.SetParameter(c4d.ID_CA_XREF_NAMESPACE, namespace, c4d.DESCFLAGS_SET_USERINTERACTION)
     if proxy:
         op.SetParameter(c4d.ID_CA_XREF_PROXY_FILE, proxy, c4d.DESCFLAGS_SET_USERINTERACTION)
-    c4d.EventAdd()
+    eventAdd()
     return op
 
 def swapXref( ref, new_ref_path ):
     try:
         ref.SetParameter(c4d.ID_CA_XREF_FILE, new_ref_path, c4d.DESCFLAGS_SET_USERINTERACTION)
-        c4d.EventAdd()
+        eventAdd()
     except: 
         debug.warning('The passed object is not a reference, or an invalid path was specified.')
     return True
@@ -162,21 +315,64 @@ def visibility( obj_=None, v=None, r=None ):
     if not (obj_):
         obj_ = ls()
     # If a flag is passed, set it
-    doc.StartUndo()
+    startUndo(doc)
     for o in obj_:
         doc.AddUndo(c4d.UNDOTYPE_CHANGE, o)
         o.SetEditorMode(vis[v])
         o.SetRenderMode(vis[r])
-    doc.EndUndo()
+    endUndo(doc)
     return
 
 def isVisible( obj_=None ):
-    ''' Check an object (and its parents) for visibility. '''
+    ''' Check an object (and its parents) for visibility. Each object in the parent chain is checked
+    once, and nothing is cached: editor / render modes and takes can change without marking the
+    document dirty. (Use resolveVisibility for a whole hierarchy.) '''
     # get the selected object if none is passed
     if not obj_:
         obj_ = ls()[0]
+    visible = True
+    while (obj_) and (visible):
+        visible = _isSelfVisible(obj_)
+        obj_ = obj_.GetUp()
+    return visible
+
+def resolveVisibility( start=None ):
+    ''' Resolves the render visibility of every object in a hierarchy in a single traversal.
+    Returns a dictionary of {BaseObject: bool}. '''
+    return dict(walkVisibility(start))
+
+def walkVisibility( start=None ):
+    ''' Walks a hierarchy top-down (same order as ObjectIterator), yielding (BaseObject, visible)
+    pairs. Visibility is inherited down the stack, so each object is only checked once. '''
+    if (start == None):
+        start = doc().GetFirstObject()
+    # the inherited visibility of the starting object's parents
+    inherited = True
+    parent    = start.GetUp() if (start) else None
+    while (parent) and (inherited):
+        inherited = _isSelfVisible(parent)
+        parent    = parent.GetUp()
+
+    stack = [(start, inherited)]
+    while stack:
+        obj, inherited = stack.pop()
+        while obj:
+            # an object is visible if it and all of its parents are
+            visible = (inherited) and _isSelfVisible(obj)
+            yield (obj, visible)
+            child = obj.GetDown()
+            if (child):
+                next_ = obj.GetNext()
+                if (next_):
+                    stack.append((next_, inherited))
+                obj, inherited = child, visible
+            else:
+                obj = obj.GetNext()
+
+def _isSelfVisible( obj_ ):
+    ''' Private. Checks a single object's own render flag and compositing tags (ignoring parents.) '''
     # first, check if the object is simply turned off
-    if obj_.GetRenderMode() == 1.0:
+    if obj_.GetRenderMode() == c4d.MODE_OFF:
         return False
     # second, check it for a compositing tag that might do so
     for tag in TagIterator(obj_):
@@ -185,14 +381,6 @@ def isVisible( obj_=None ):
                 return False
             elif tag[c4d.COMPOSITINGTAG_SEENBYCAMERA] == 0:
                 return False
-    # we must also iterate over the parents of the object
-    parent = obj_.GetUp()
-    while parent:
-        if not isVisible(parent):
-            return False
-        else:
-            parent = parent.GetUp()
-    # all the parents must be visible
     return True
 
 def tag( obj_=None, typ=None, name=None ):
@@ -204,7 +392,7 @@ def tag( obj_=None, typ=None, name=None ):
     # Empty return container
     tags = []
     # Make a tag for each object
-    doc.StartUndo()
+    startUndo(doc)
     for o in obj:
         tag = o.MakeTag(typ)
         # Add the tag to the return list
@@ -214,125 +402,133 @@ def tag( obj_=None, typ=None, name=None ):
             tag.SetName(name)
         doc.AddUndo(c4d.UNDOTYPE_NEW, tag)
 
-    c4d.EventAdd()
-    doc.EndUndo()
+    invalidateIndex(doc)
+    eventAdd()
+    endUndo(doc)
     return tags
 
 # MATERIALS & TEXTURES ############################################################################
 def changeTexture( mat, tex_path, channel=c4d.MATERIAL_COLOR_SHADER ):
     ''' Changes the texture on a material's specified channel.  Defaults to the color channel.
     C:\Program Files\MAXON\CINEMA 4D R17\resource\modules\c4dplugin\description\mmaterial.h '''
-    doc = c4d.documents.GetActiveDocument()
     if isinstance(mat, str):
-        for mat_ in MaterialIterator(doc()):
-            if mat_.GetName() == mat:
-                mat = mat_
-                break
-
-    if not isinstance(mat, c4d.Material):
+        assignMaterials({mat: {channel: tex_path}}, exact=True, kind='texture')
+    elif isinstance(mat, c4d.Material):
+        _applyMaterial(mat, {channel: tex_path}, kind='texture')
+    else:
         return
-
-    doc.StartUndo()
-    if type(channel) == int:
-        tex = c4d.BaseList2D(c4d.Xbitmap)
-        doc.AddUndo(c4d.UNDOTYPE_CHANGE, tex)
-        tex[c4d.BITMAPSHADER_FILENAME] = tex_path
-        mat[channel] = tex
-        mat.InsertShader(tex)
-    elif channel == ('refl' or 'reflection'):
-        refl_shd = mat.GetAllReflectionShaders()
-        for rs in refl_shd:
-            doc.AddUndo(c4d.UNDOTYPE_CHANGE, rs)
-            rs[c4d.BITMAPSHADER_FILENAME] = tex_path
-
-    mat.Message(c4d.MSG_UPDATE)
-    mat.Update(1,1)
-    c4d.EventAdd()
-    c4d.EndUndo()
     return True
 
 def changeColor( mat, vector, channel=c4d.MATERIAL_COLOR_COLOR, exact=True ):
     ''' Changes the color on a material's specified channel.  Defaults to the diffuse color channel.'''
-    mats = []
-    doc  = c4d.documents.GetActiveDocument()
     if isinstance(mat, str):
-        for mat_ in MaterialIterator(doc()):
-            if (exact):
-                if mat_.GetName() == mat:
-                    mats.append(mat_)
-            elif not (exact):
-                if mat in mat_.GetName():
-                    mats.append(mat_)
-
+        assignMaterials({mat: {channel: vector}}, exact=exact, kind='color')
     elif isinstance(mat, c4d.Material):
-        mats = list(mat)
-
-    if type(channel) == int:
-        doc.StartUndo()
-        for mat_ in mats:
-            doc.AddUndo(c4d.UNDOTYPE_CHANGE, mat_)
-            mat_[channel] = vector
-            mat_.Message(c4d.MSG_UPDATE)
-            mat_.Update(1,1)
-    c4d.EventAdd()
-    doc.EndUndo()
+        _applyMaterial(mat, {channel: vector}, kind='color')
     return True
 
+def assignMaterials( assignments, exact=False, kind=None ):
+    ''' Applies colors and textures to many materials at once: the materials are scanned once, and
+    every change is made in a single undo step with a single scene update.
+    assignments (dict): {name pattern: {channel: value}}.
+    kind (str): 'color' sets every value directly on its channel (a c4d.Vector, or a number for
+        brightness-type channels); 'texture' sets a bitmap texture path on a shader channel ('refl'
+        sets all reflection layers.) If no kind is passed, it's taken from each value's type.
+    exact (bool): match material names exactly, rather than by substring.
+    Raises TypeError (before changing anything) for a value that doesn't fit its kind.
+    Returns: {name pattern: [matched materials]} '''
+    doc = c4d.documents.GetActiveDocument()
+    changes = dict((pattern, _materialChanges(values, kind)) for pattern, values in assignments.iteritems())
+    matches = dict((pattern, []) for pattern in assignments)
+    for mat in traverse.materials(doc):
+        name = mat.GetName()
+        if (exact):
+            if name in matches:
+                matches[name].append(mat)
+        else:
+            for pattern in assignments:
+                if pattern in name:
+                    matches[pattern].append(mat)
+
+    startUndo(doc)
+    for pattern, mats in matches.iteritems():
+        _applyMaterials(mats, changes[pattern], doc=doc)
+    endUndo(doc)
+    eventAdd()
+    return matches
+
+def _materialChanges( values, kind=None ):
+    ''' Private. Checks {channel: value} against the kind of change (see assignMaterials.)
+    Returns: [(channel, kind, value)] '''
+    changes = []
+    for channel, value in values.iteritems():
+        value_kind = kind
+        if (value_kind == None):
+            value_kind = 'texture' if isinstance(value, basestring) else 'color'
+        if (value_kind == 'color'):
+            if not isinstance(value, (c4d.Vector, int, long, float)) or isinstance(value, bool):
+                raise TypeError('Invalid color value for channel {0}: {1!r}'.format(channel, value))
+        elif (value_kind == 'texture'):
+            if not isinstance(value, basestring):
+                raise TypeError('Invalid texture path for channel {0}: {1!r}'.format(channel, value))
+        else:
+            raise ValueError('Unknown material change: {0}'.format(value_kind))
+        changes.append((channel, value_kind, value))
+    return changes
+
+def _applyMaterial( mat, values, kind=None ):
+    ''' Private. Sets {channel: value} on a single material in its own undo step, and updates the
+    scene (see assignMaterials.) '''
+    changes = _materialChanges(values, kind)
+    doc = c4d.documents.GetActiveDocument()
+    startUndo(doc)
+    _applyMaterials([mat], changes, doc=doc)
+    endUndo(doc)
+    eventAdd()
+
+def _applyMaterials( mats, changes, doc=None ):
+    ''' Private. Makes a list of checked changes (see _materialChanges) on a list of materials, adding
+    undos but without opening an undo group or updating the scene. '''
+    if (doc == None):
+        doc = c4d.documents.GetActiveDocument()
+    for mat in mats:
+        doc.AddUndo(c4d.UNDOTYPE_CHANGE, mat)
+        for channel, kind, value in changes:
+            if (kind == 'color'):
+                mat[channel] = value
+            elif (channel == 'refl') or (channel == 'reflection'):
+                for rs in mat.GetAllReflectionShaders():
+                    doc.AddUndo(c4d.UNDOTYPE_CHANGE, rs)
+                    rs[c4d.BITMAPSHADER_FILENAME] = value
+            else:
+                tex = c4d.BaseList2D(c4d.Xbitmap)
+                tex[c4d.BITMAPSHADER_FILENAME] = value
+                mat[channel] = tex
+                mat.InsertShader(tex)
+        mat.Message(c4d.MSG_UPDATE)
+        mat.Update(1,1)
+
 def createMaterial(name=None, color=None):
     ''' Create a new material. '''
     doc = c4d.documents.GetActiveDocument()
     mat = c4d.BaseMaterial(c4d.Mmaterial)
-    doc.StartUndo()
+    startUndo(doc)
     doc.InsertMaterial(mat)
     if (name):
         mat.SetName(name)
     if (color):
         changeColor(mat, color)
     doc.AddUndo(c4d.UNDOTYPE_NEW, mat)
-    c4d.EventAdd()
-    doc.EndUndo()
+    eventAdd()
+    endUndo(doc)
     return mat
 
 def getSceneTextures():
     ''' An object-based version of doc.GetAllTextures() -- i.e., returns an array of BaseList2D
-        instead of a useless string tuple. 
-        returns: Shader/channel (as BaseShader), path to bitmap (as str)'''
-    # A list of shaders (channels) where textures may be found
-    shaders = [
-        c4d.MATERIAL_COLOR_SHADER,
-        c4d.MATERIAL_DIFFUSION_SHADER,
-        c4d.MATERIAL_LUMINANCE_SHADER,
-        c4d.MATERIAL_TRANSPARENCY_SHADER,
-        c4d.MATERIAL_REFLECTION_SHADER,
-        c4d.MATERIAL_ENVIRONMENT_SHADER,
-        c4d.MATERIAL_BUMP_SHADER,
-        c4d.MATERIAL_ALPHA_SHADER,
-        c4d.MATERIAL_SPECULAR_SHADER,
-        c4d.MATERIAL_DISPLACEMENT_SHADER,
-        c4d.MATERIAL_NORMAL_SHADER
-        ]
-    # output container
-    output = []
-    # iterate over all materials in the scene
-    for mat in MaterialIterator(doc()):
-        # the standard list of channels / shaders (including legacy reflection/specular)
-        for shd in shaders:
-            # test material for active shader
-            shd = mat[shd]
-            if (shd):
-                # test that active shader for a bitmap 
-                tex_path = shd[c4d.BITMAPSHADER_FILENAME]
-                if (tex_path):
-                    # get the path and add it to the list
-                    tex_path = c4d.GenerateTexturePath(doc().GetDocumentPath(), tex_path, '')
-                    output.append([shd, tex_path])
-        # the new-style of reflection/specular channels
-        for shd in mat.GetAllReflectionShaders():
-            tex_path = shd[c4d.BITMAPSHADER_FILENAME]
-            if (tex_path):
-                tex_path = c4d.GenerateTexturePath(doc().GetDocumentPath(), tex_path, '')
-                output.append([shd, tex_path])
-    return output
+        instead of a useless string tuple. Bitmaps nested in layer/fusion shaders are included.
+        returns: Shader/channel (as BaseShader), path to bitmap (as str)
+        (see textures.scan for a streaming version with material & channel information.)'''
+    return [[ref.shader, ref.path] for ref in textures.scan(doc())]
 
 def getGlobalTexturePaths():
     ''' Generates a list of all the user's global texture paths locations. '''
@@ -356,40 +552,40 @@ def take( name=None, set_active=False ):
         if (take.GetName() == name):
             return take
 
-    doc.StartUndo()
-    # Otherwise add the take and name it
-    take = td.AddTake(name, parent=None, cloneFrom=None)
-    # Add the default override groups to the take
-    doc.AddUndo(c4d.UNDOTYPE_NEW, take)
-    for og_ in OVERRIDE_GROUPS:
-        if og_ == 'bty':
-            continue
-        og = override(take, og_)
-        mat = createMaterial()
-        # Add the compositing tag for overriding
-        tag = og.AddTag(td, c4d.Tcompositing, mat=mat)
-        tag.SetName('VISIBILITY_OVERRIDE')
-        # ... and set the default values
-        setCompositingTag( tag, og_ )
-        mat.Remove()
-    # If flagged, set the current take as active
-    doc.AddUndo(c4d.UNDOTYPE_CHANGE, take)
-    if (set_active): td.SetCurrentTake(take)
-    take.SetChecked(True)
-
-    c4d.EventAdd()
-    doc.EndUndo()
+    # The override groups, materials and tags below join a single undo step and scene update
+    with Transaction(doc):
+        # Otherwise add the take and name it
+        take = td.AddTake(name, parent=None, cloneFrom=None)
+        # Add the default override groups to the take
+        doc.AddUndo(c4d.UNDOTYPE_NEW, take)
+        for og_ in OVERRIDE_GROUPS:
+            if og_ == 'bty':
+                continue
+            og = override(take, og_)
+            mat = createMaterial()
+            # Add the compositing tag for overriding
+            tag = og.AddTag(td, c4d.Tcompositing, mat=mat)
+            tag.SetName('VISIBILITY_OVERRIDE')
+            # ... and set the default values
+            setCompositingTag( tag, og_ )
+            mat.Remove()
+        # If flagged, set the current take as active
+        doc.AddUndo(c4d.UNDOTYPE_CHANGE, take)
+        if (set_active): td.SetCurrentTake(take)
+        take.SetChecked(True)
+
+        eventAdd()
     return take
 
 def setOutputPaths( rgb_path, multi_path ):
     doc = c4d.documents.GetActiveDocument()
     rd  = doc.GetActiveRenderData()
-    doc.StartUndo()
+    startUndo(doc)
     doc.AddUndo(c4d.UNDOTYPE_CHANGE, rd)
     rd[c4d.RDATA_PATH] = str(rgb_path)
     rd[c4d.RDATA_MULTIPASS_FILENAME] = str(multi_path)
-    doc.EndUndo()
-    c4d.EventAdd()
+    endUndo(doc)
+    eventAdd()
     return True
 
 def setOutputFiletype( filetype, depth=None, primary=True, multipass=True, rd=None ):
@@ -408,7 +604,7 @@ def setOutputFiletype( filetype, depth=None, primary=True, multipass=True, rd=No
         16: 1,
         32: 2
     }
-    doc.StartUndo()
+    startUndo(doc)
     if (primary == True):
         rd[c4d.RDATA_FORMAT] = format_lookup[filetype]
         if ((depth != None) and (filetype != 'exr')):
@@ -419,8 +615,8 @@ def setOutputFiletype( filetype, depth=None, primary=True, multipass=True, rd=No
         if ((depth != None) and (filetype != 'exr')):
             rd[c4d.RDATA_MULTIPASS_SAVEDEPTH] = depth_lookup[depth]
 
-    c4d.EventAdd()
-    doc.EndUndo()
+    eventAdd()
+    endUndo(doc)
     return True
 
 def override( take, name=None ):
@@ -428,7 +624,7 @@ def override( take, name=None ):
     og = take.AddOverrideGroup()
     if (name): og.SetName(name)
 
-    c4d.EventAdd()
+    eventAdd()
     return og
 
 def getCheckedTakes():
@@ -483,7 +679,7 @@ def setCompositingTag( tag, preset, reset=False ):
         og.SetEditorMode(c4d.MODE_ON)
         og.SetEditorMode(c4d.MODE_ON)
 
-    c4d.EventAdd()
+    eventAdd()
     return
 
 def createRenderData( rd, name ):
@@ -491,7 +687,7 @@ def createRenderData( rd, name ):
     name.  Seriously, fuck C4D sometimes. '''
     doc   = c4d.documents.GetActiveDocument()
     start = doc.GetFirstRenderData()
-    doc.StartUndo()
+    startUndo(doc)
     for rd_ in ObjectIterator(start):
         if rd_.GetName() == name:
             doc.AddUndo(c4d.UNDOTYPE_DELETE, rd_)
@@ -500,8 +696,8 @@ def createRenderData( rd, name ):
     doc.InsertRenderData(rd)
     doc.AddUndo(c4d.UNDOTYPE_NEW, rd)
     doc.SetActiveRenderData(rd)
-    c4d.EventAdd()
-    doc.EndUndo()
+    eventAdd()
+    endUndo(doc)
     return
 
 def createChildRenderData( rd, suffix=False, set_active=False ):
@@ -511,7 +707,7 @@ def createChildRenderData( rd, suffix=False, set_active=False ):
         gui.MessageDialog(msg)
         return False
     doc = c4d.documents.GetActiveDocument()
-    doc.StartUndo()
+    startUndo(doc)
     child_rdata = c4d.documents.RenderData()
     child_rdata.SetData(rd.GetData())
     doc.InsertRenderData(child_rdata, pred=rd)
@@ -533,8 +729,8 @@ def createChildRenderData( rd, suffix=False, set_active=False ):
         child_rdata.SetName(name)
     if (set_active): doc.SetActiveRenderData(child_rdata)
 
-    c4d.EventAdd()
-    doc.EndUndo()
+    eventAdd()
+    endUndo(doc)
     return child_rdata
         
 ### The following iterators were borrowed directly from Martin Weber via cgrebel.com.
@@ -574,7 +770,7 @@ class ObjectIterator:
 class TagIterator:
     ''' Iterates over all tags on a given object. '''
     def __init__(self, obj):
-        currentTag = None
+        self.currentTag = None
         if obj :
             self.currentTag = obj.GetFirstTag()
 
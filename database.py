@@ -1,77 +1,424 @@
 # JSON Database operations for ESPN Animation projects pipeline
 
 import c4d
+import bisect
 import json
+import marshal
+import os
 import os.path
+import threading
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 #
 from espntools import debug
+from espntools import filesystem
 
 __schema__     = [1.0, 1.0]
 __platform__   = "c4d"
 __dashboard__  = None
 __nasroot__    = "Y:\\Workspace"
 __pubroot__    = "Y:\\PublishData"
+__uncroots__   = {"Y:": "\\\\cagenas", "W:": "\\\\cagenas"}
 __logdir__     = "Y:\\Workspace\\SCRIPTS\\ESPNTools\\.logs\\{0}"
 __globaldb__   = "Y:\\Workspace\\SCRIPTS\\ESPNTools\\.json\\productions.json"
 __assetsdb__   = "Y:\\Workspace\\SCRIPTS\\ESPNTools\\.json\\global_assets.json"
+__snapshotdb__ = "Y:\\Workspace\\SCRIPTS\\ESPNTools\\.json\\productions.snapshot"
+__sqlitedb__   = "Y:\\Workspace\\SCRIPTS\\ESPNTools\\.json\\productions.sqlite"
+__texturedb__  = "Y:\\Workspace\\SCRIPTS\\ESPNTools\\.json\\textures_{0}.index"
+__hashdb__     = "Y:\\Workspace\\SCRIPTS\\ESPNTools\\.json\\hashes.cache"
+__storeroot__  = "Y:\\Workspace\\.store"
+__backend__    = "json"
+__projectttl__ = 60.0
 __c4dpresets__ = "preset://espn.lib4d/{0}/{1}"
 
-# GETTERS ##########################################################################################
-def getProduction(prod_):
-    ''' Gets a production's global variables from the database. '''
-    def merge(src,dest):
-        for k,v in src:
-            dest[k] = v
+# CACHE ############################################################################################
+class FrozenDict(dict):
+    ''' A read-only dictionary. Records handed out by the database cache are frozen so that callers
+    can't corrupt the cached copy -- use copy() to get a mutable (deep) copy instead. '''
+    def _readonly(self, *a, **kw):
+        raise TypeError('Database records are read-only. Use copy() to get an editable version.')
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def copy(self):
+        return thaw(self)
+
+def freeze(data):
+    ''' Recursively converts parsed JSON into read-only containers (dicts to FrozenDict, lists to
+    tuples.) '''
+    if isinstance(data, dict):
+        return FrozenDict((k, freeze(v)) for k,v in data.iteritems())
+    elif isinstance(data, (list, tuple)):
+        return tuple(freeze(v) for v in data)
+    return data
+
+def thaw(data):
+    ''' The inverse of freeze() -- returns a mutable deep copy of a frozen record. '''
+    if isinstance(data, dict):
+        return dict((k, thaw(v)) for k,v in data.iteritems())
+    elif isinstance(data, (list, tuple)):
+        return [thaw(v) for v in data]
+    return data
+
+class JsonCache(object):
+    ''' In-process cache of parsed JSON databases, keyed by file path. A file is only re-read from
+    the server when its modification time or size changes; otherwise the cached (frozen) copy is
+    returned. If a snapshot is attached, cache misses are served from it before falling back to
+    parsing the JSON. '''
+    def __init__(self, snapshot=None):
+        self.hits    = 0
+        self.misses  = 0
+        self.snapshot= snapshot
+        self._lock   = threading.RLock()
+        self._entries= {}
+
+    @staticmethod
+    def signature(path):
+        ''' Returns the (mtime, size) pair used to detect changes to a file on disk. '''
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            raise IOError(e.errno, e.strerror, path)
+        return (st.st_mtime, st.st_size)
 
-    merged_prod = {}
-    with open(__globaldb__, 'r') as stream:
-        full_db = json.load(stream)
+    def get(self, path):
+        ''' Returns the parsed (read-only) contents of a JSON file. '''
+        sig = self.signature(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if (entry) and (entry[0] == sig):
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            data = None
+            if (self.snapshot):
+                data = self.snapshot.lookup(path, sig)
+            if (data == None):
+                with open(path, 'r') as stream:
+                    data = json.load(stream)
+            data = freeze(data)
+            self._entries[path] = (sig, data)
+            return data
 
+    def invalidate(self, path=None):
+        ''' Drops one file (or every file, if no path is passed) from the cache. '''
+        with self._lock:
+            if (path == None):
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries)
+                }
+            if (self.snapshot):
+                stats['snapshot_hits'] = self.snapshot.hits
+            return stats
+
+class Snapshot(object):
+    ''' A precompiled binary (marshal) copy of the JSON databases, stored as a sidecar to
+    productions.json. Each file in the snapshot carries the (mtime, size) signature it was compiled
+    from, and is only used while the JSON file on disk still matches it. The whole snapshot is
+    ignored if it was compiled against a different __schema__ or marshal version. '''
+    def __init__(self, path=None):
+        self._path  = path
+        self._sig   = None
+        self._files = {}
+        self.hits   = 0
+
+    @property
+    def path(self):
+        return self._path or __snapshotdb__
+
+    @staticmethod
+    def header():
+        return (tuple(__schema__), marshal.version)
+
+    def lookup(self, path, sig):
+        ''' Returns the snapshotted contents of a JSON file, or None if it is missing or stale. '''
+        self._refresh()
+        entry = self._files.get(path)
+        if (entry) and (entry[0] == sig):
+            self.hits += 1
+            return entry[1]
+        return None
+
+    def _refresh(self):
+        try:
+            sig = JsonCache.signature(self.path)
+        except IOError:
+            self._sig, self._files = None, {}
+            return
+        if (sig == self._sig):
+            return
+        self._sig, self._files = sig, {}
         try:
-            prod_db = full_db[prod_]
-        except KeyError:
-            raise debug.DatabaseError(1)
-        # The project dictionaries only store the delta of data in the default dictionary
-        # Therefore we merge the requested project dictionary over top of the default to create
-        # a complete data set.
-        return prod_db
+            with open(self.path, 'rb') as stream:
+                header, files = marshal.load(stream)
+        except (EOFError, ValueError, TypeError):
+            debug.warning('Database snapshot is unreadable, falling back to JSON', self.path)
+            return
+        if (header == self.header()):
+            self._files = files
+        else:
+            debug.warning('Database snapshot is out of date, falling back to JSON', self.path)
+
+    @classmethod
+    def compile(cls, paths, path=None):
+        ''' Compiles the passed JSON files into a snapshot. Written to a temporary file that replaces
+        the snapshot in one step, so that readers never see a partial (or missing) snapshot. '''
+        files = {}
+        for json_path in paths:
+            sig = JsonCache.signature(json_path)
+            with open(json_path, 'r') as stream:
+                files[json_path] = (sig, json.load(stream))
+
+        snapshot_path = path or __snapshotdb__
+        # a unique temporary file (two builds may run at once), swapped in with a single replace
+        temp_path     = filesystem.tempPath(snapshot_path)
+        try:
+            with open(temp_path, 'wb') as stream:
+                marshal.dump((cls.header(), files), stream)
+            filesystem.replace(temp_path, snapshot_path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return files.keys()
+
+_cache = JsonCache(snapshot=Snapshot())
+
+def getCacheStats():
+    ''' Returns the hit/miss counters of the database cache. '''
+    return _cache.stats()
+
+def clearCache():
+    ''' Forces every database file to be re-read on its next access. '''
+    _cache.invalidate()
+
+def compileSnapshot(path=None):
+    ''' Compiles productions.json and every production's platform / team databases into a single
+    binary snapshot, which the getters load in place of the JSON for as long as it's current.
+    Re-run after editing the databases (stale files are simply read from JSON until then.)
+    Returns the list of snapshotted files. '''
+    paths = [__globaldb__]
+    for prod_ in getAllProductions():
+        for json_path in getProduction(prod_).get('json', {}).itervalues():
+            if (json_path not in paths) and os.path.isfile(json_path):
+                paths.append(json_path)
+    if os.path.isfile(__assetsdb__):
+        paths.append(__assetsdb__)
+    return Snapshot.compile(paths, path=path)
+
+# BACKENDS #########################################################################################
+class JsonBackend(object):
+    ''' Storage backend reading the flat JSON databases (through the JSON cache and snapshot.) '''
+    name = 'json'
+
+    def records(self):
+        ''' Returns every top-level record in the global database (productions, DEFAULT, etc.) '''
+        return _cache.get(__globaldb__)
+
+    def platformData(self, prod_):
+        return _cache.get(_resolve(self.records(), prod_)['json']['c4d'])
+
+    def teamDatabase(self, prod_):
+        return _cache.get(_resolve(self.records(), prod_)['json']['teams'])
+
+    def team(self, prod_, tricode):
+        return self.teamDatabase(prod_).get(tricode)
+
+    def clear(self):
+        ''' Nothing to drop: the parsed files live in the JSON cache. '''
+        pass
+
+    def close(self):
+        pass
+
+class SqliteBackend(object):
+    ''' Storage backend reading a SQLite copy of the JSON databases (see importToSqlite.) Single-team
+    questions are answered with an indexed query instead of loading the production's team database.
+    Results are cached until the SQLite file changes on disk. '''
+    name = 'sqlite'
+    # memoized query results kept before the memo is dropped
+    MEMO_SIZE = 4096
+
+    SCHEMA = (
+        'CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)',
+        'CREATE TABLE records (name TEXT PRIMARY KEY, data TEXT)',
+        'CREATE TABLE platform (production TEXT PRIMARY KEY, data TEXT)',
+        'CREATE TABLE teams (production TEXT, tricode TEXT, data TEXT, PRIMARY KEY (production, tricode))',
+        'CREATE INDEX teams_tricode ON teams (tricode)'
+        )
+
+    def __init__(self, path=None):
+        if (sqlite3 == None):
+            raise debug.DatabaseError(4)
+        self._path  = path
+        self._local = threading.local()
+        self._lock  = threading.Lock()
+        self._sig   = None
+        self._memo  = {}
+
+    @property
+    def path(self):
+        return self._path or __sqlitedb__
+
+    def _query(self, key, sql, args, parse):
+        ''' Runs a query (memoized by key until the database file changes) and parses its rows. '''
+        sig = JsonCache.signature(self.path)
+        with self._lock:
+            if not (sig == self._sig):
+                self._sig, self._memo = sig, {}
+            elif key in self._memo:
+                return self._memo[key]
+        # sqlite connections may only be used by the thread that created them
+        conn = getattr(self._local, 'conn', None)
+        if (conn == None):
+            conn = self._local.conn = sqlite3.connect(self.path)
+        result = parse(conn.execute(sql, args).fetchall())
+        with self._lock:
+            if (sig == self._sig):
+                if (len(self._memo) >= self.MEMO_SIZE):
+                    self._memo = {}
+                self._memo[key] = result
+        return result
+
+    def clear(self):
+        ''' Drops the memoized query results (the connections are kept.) '''
+        with self._lock:
+            self._sig, self._memo = None, {}
+
+    def close(self):
+        ''' Closes the calling thread's connection (sqlite connections belong to the thread that made
+        them; any others are closed when their thread ends.) '''
+        conn = getattr(self._local, 'conn', None)
+        if (conn != None):
+            conn.close()
+            self._local.conn = None
+
+    def records(self):
+        return self._query(('records',), 'SELECT name, data FROM records', (),
+            lambda rows: freeze(dict((k, json.loads(v)) for k,v in rows)))
+
+    def platformData(self, prod_):
+        def parse(rows):
+            if not (rows):
+                raise IOError('No platform data for production', prod_)
+            return freeze(json.loads(rows[0][0]))
+        return self._query(('platform', prod_), 'SELECT data FROM platform WHERE production=?', (prod_,),
+            parse)
+
+    def teamDatabase(self, prod_):
+        return self._query(('teams', prod_), 'SELECT tricode, data FROM teams WHERE production=?', (prod_,),
+            lambda rows: freeze(dict((k, json.loads(v)) for k,v in rows)))
+
+    def team(self, prod_, tricode):
+        return self._query(('team', prod_, tricode),
+            'SELECT data FROM teams WHERE production=? AND tricode=?', (prod_, tricode),
+            lambda rows: freeze(json.loads(rows[0][0])) if (rows) else None)
+
+    @classmethod
+    def build(cls, source, path=None):
+        ''' Imports everything readable through the source backend into a new SQLite database. The
+        database is built in a (unique) temporary file, which replaces the database in one step when
+        complete. '''
+        if (sqlite3 == None):
+            raise debug.DatabaseError(4)
+        db_path   = path or __sqlitedb__
+        temp_path = filesystem.tempPath(db_path)
+
+        records = source.records()
+        conn    = sqlite3.connect(temp_path)
+        try:
+            for statement in cls.SCHEMA:
+                conn.execute(statement)
+            conn.execute('INSERT INTO meta VALUES (?,?)', ('schema', json.dumps(__schema__)))
+            conn.executemany('INSERT INTO records VALUES (?,?)',
+                ((k, json.dumps(thaw(v))) for k,v in records.iteritems()))
+            for prod_ in records:
+                if (prod_ == 'NULL' or prod_ == 'ESPN_META' or prod_ == 'FOLDER_TEMPLATE'):
+                    continue
+                try:
+                    conn.execute('INSERT INTO platform VALUES (?,?)',
+                        (prod_, json.dumps(thaw(source.platformData(prod_)))))
+                    conn.executemany('INSERT INTO teams VALUES (?,?,?)',
+                        ((prod_, k, json.dumps(thaw(v))) for k,v in source.teamDatabase(prod_).iteritems()))
+                except (IOError, KeyError):
+                    debug.warning('Skipped incomplete production during SQLite import', prod_)
+            conn.commit()
+            conn.close()
+            filesystem.replace(temp_path, db_path)
+        except:
+            conn.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return db_path
+
+_backends = {'json': JsonBackend, 'sqlite': SqliteBackend}
+_backend  = _backends[__backend__]()
+
+def setBackend(name, **kwargs):
+    ''' Switches the storage backend used by all getters ('json' or 'sqlite'.) '''
+    global _backend
+    _backend.close()
+    _backend = _backends[name](**kwargs)
+    return _backend
+
+def getBackend():
+    return _backend
+
+def importToSqlite(path=None):
+    ''' Imports the JSON databases into a SQLite database for use with setBackend('sqlite'). '''
+    return SqliteBackend.build(JsonBackend(), path=path)
+
+# GETTERS ##########################################################################################
+def getProduction(prod_):
+    ''' Gets a production's global variables from the database. '''
+    return _resolve(_backend.records(), prod_)
 
 def getFolderStructure():
-    with open(__globaldb__, 'r') as stream:
-        return json.load(stream)["FOLDER_TEMPLATE"]
+    return _backend.records()["FOLDER_TEMPLATE"]
 
 def getPlatformData(prod_):
     ''' Gets the platform (C4D-specific) data for a particular production.'''
-    with open(getProduction(prod_)['json']['c4d']) as stream:
-        return json.load(stream)
+    return _backend.platformData(prod_)
         
 
 def getAllProductions():
     ''' Gets a list of all available / valid productions from the database. '''
     productions = []
-    with open(__globaldb__, 'r') as stream:
-        full_db = json.load(stream)
-        for k,v in full_db.iteritems():
-            if (k == 'NULL' or k == 'ESPN_META' or k == 'FOLDER_TEMPLATE'):
-                continue
-            else:
-                productions.append(k)
+    full_db = _backend.records()
+    for k,v in full_db.iteritems():
+        if (k == 'NULL' or k == 'ESPN_META' or k == 'FOLDER_TEMPLATE'):
+            continue
+        else:
+            productions.append(k)
     return sorted(productions)
 
 def getAllProjects(prod_):
-    ''' Gets all projects associated with a production.'''
+    ''' Gets all projects associated with a production. The folder listing is cached for
+    __projectttl__ seconds (see startProjectRefresher to keep it warm in the background.)'''
     prod = getProduction(prod_)
-    #return [p for p in os.listdir(prod['project']) if os.path.isdir(os.path.join(prod['project'], p))]
-    proj_list = []
-    try:
-        dirs = os.listdir(prod['folder_lookup']['animroot'])
-        for d in dirs:
-            if (os.path.isdir(os.path.join(prod['folder_lookup']['animroot'], d))):
-                proj_list.append(d)
-    except WindowsError:
-        pass
-    return sorted(proj_list)
+    return _projects.get(prod['folder_lookup']['animroot'])
+
+def startProjectRefresher(interval=None):
+    ''' Keeps the project listings of every production that has been looked up warm on a background
+    thread, so that the UI never waits on the server to list projects. '''
+    return _projects.startRefresher(interval)
+
+def stopProjectRefresher():
+    _projects.stopRefresher()
 
+_projects = filesystem.DirectoryCache(ttl=__projectttl__)
 
 def getAllPresets(prod_):
     ''' Gets all render presets associated with a production.'''
@@ -80,40 +427,36 @@ def getAllPresets(prod_):
     
 def getTeamDatabase(prod_):
     ''' Gets the team database for a production. '''
-    prod_db  = getProduction(prod_)
-    with open(prod_db['json']['teams'], 'r') as stream:
-        return json.load(stream)
+    return _backend.teamDatabase(prod_)
+
+def getTeamIndex(prod_):
+    ''' Gets the (cached) lookup index for a production's team database. The index is rebuilt only
+    when the team database itself is reloaded. '''
+    team_db = getTeamDatabase(prod_)
+    with _index_lock:
+        index = _team_indexes.get(prod_)
+        if (index == None) or not (index.source is team_db):
+            index = TeamIndex(team_db)
+            _team_indexes[prod_] = index
+        return index
 
 def getTeam(prod_, lookup, squelch=False):
     ''' Gets a team from a production using its key.'''
-    team_db = getTeamDatabase(prod_)
-    for k,v in team_db.iteritems():
-        if (k == lookup):
-            return team_db[k]
+    return _backend.team(prod_, lookup)
 
     # if it gets this far, the team wasn't found in the database.
     #raise debug.DatabaseError(2, alert=1-squelch)
 
 def getAllTeams(prod_, name='tricode'):
     ''' Gets a list of all teams for a given production. '''
-    team_db = getTeamDatabase(prod_)
-    team_ls = []
-    if name == 'tricode':
-        for k in team_db:
-            team_ls.append(k)
-        return sorted(team_ls)
-    elif name == 'full':
-        for k,v in team_db.iteritems():
-            team_ls.append('{0} {1}'.format(team_db[k]['city'], team_db[k]['nick']))
-        return sorted(team_ls)
-    elif name == 'city':
-        for k,v in team_db.iteritems():
-            team_ls.append('{0}'.format(team_db[k]['city']))
-        return sorted(team_ls)
-    elif name == 'nick':
-        for k,v in team_db.iteritems():
-            team_ls.append('{0}'.format(team_db[k]['nick']))
-        return sorted(team_ls)
+    index = getTeamIndex(prod_)
+    if name in index.lists:
+        return list(index.lists[name])
+
+def searchTeams(prod_, text, name='tricode'):
+    ''' Case-insensitive prefix search of a production's teams, for autocompletion. Returns a list of
+    matching tricodes, sorted by the searched field. '''
+    return getTeamIndex(prod_).search(text, name=name)
 
 def getTeamColors(prod_, lookup, squelch=False):
     team = getTeam(prod_, lookup, squelch=squelch)
@@ -126,11 +469,93 @@ def getTeamColors(prod_, lookup, squelch=False):
 
 def isTricode(prod_, tricode):
     try:
-        team = getTeam(prod_, tricode)
-        return True
-    except:
+        return not (getTeam(prod_, tricode) == None)
+    except (IOError, KeyError, debug.DatabaseError):
         return False
 
+def _resolve(full_db, prod_):
+    ''' Private. Resolves a production record from the passed global database. '''
+    try:
+        prod_db = full_db[prod_]
+    except KeyError:
+        raise debug.DatabaseError(1)
+    # The project dictionaries only store the delta of data in the default dictionary
+    # Therefore we merge the requested project dictionary over top of the default to create
+    # a complete data set.  The merged record is memoized until the database is reloaded.
+    with _resolve_lock:
+        source, merged_prod = _resolved.get(prod_, (None, None))
+        if not (source is full_db):
+            merged_prod = freeze(merge(full_db.get('DEFAULT', {}), prod_db))
+            _resolved[prod_] = (full_db, merged_prod)
+        return merged_prod
+
+def merge(src, delta):
+    ''' Deep-merges a delta dictionary over top of a source dictionary. Nested dictionaries are merged
+    key-by-key; any other value in the delta replaces the source value. Returns a new (mutable)
+    dictionary -- neither input is modified. '''
+    merged = thaw(src)
+    for k,v in delta.iteritems():
+        if isinstance(v, dict) and isinstance(merged.get(k), dict):
+            merged[k] = merge(merged[k], v)
+        else:
+            merged[k] = thaw(v)
+    return merged
+
+# INDEXES ##########################################################################################
+class TeamIndex(object):
+    ''' Lookup tables for a production's team database. Built once per version of the database so
+    that tricode lookups are O(1) and the sorted name lists don't have to be rebuilt on each call. '''
+    def __init__(self, team_db):
+        self.source = team_db
+        self.lists  = {'tricode': [], 'full': [], 'city': [], 'nick': []}
+        self._upper = {}
+        # (lowercase value, tricode) pairs, sorted for prefix searches
+        self._keys  = {'tricode': [], 'full': [], 'city': [], 'nick': []}
+
+        for tricode, team in team_db.iteritems():
+            fields = {
+                'tricode': tricode,
+                'full': '{0} {1}'.format(team['city'], team['nick']),
+                'city': '{0}'.format(team['city']),
+                'nick': '{0}'.format(team['nick'])
+                }
+            for name, value in fields.iteritems():
+                self.lists[name].append(value)
+                self._keys[name].append((value.lower(), tricode))
+            self._upper[tricode.upper()] = tricode
+
+        for name in self.lists:
+            self.lists[name].sort()
+            self._keys[name].sort()
+
+    def get(self, tricode):
+        ''' Returns a team record by its exact tricode, or None. '''
+        return self.source.get(tricode)
+
+    def find(self, tricode):
+        ''' Returns a team record by its tricode, ignoring case, or None. '''
+        return self.source.get(self._upper.get(tricode.upper()))
+
+    def isTricode(self, tricode):
+        return tricode in self.source
+
+    def search(self, text, name='tricode'):
+        ''' Returns the tricodes of all teams whose field (tricode / full / city / nick) starts with the
+        passed text, ignoring case. '''
+        keys   = self._keys[name]
+        prefix = text.lower()
+        found  = []
+        for i in xrange(bisect.bisect_left(keys, (prefix,)), len(keys)):
+            if not keys[i][0].startswith(prefix):
+                break
+            found.append(keys[i][1])
+        return found
+
+_team_indexes = {}
+_index_lock   = threading.Lock()
+_resolved     = {}
+_resolve_lock = threading.Lock()
+
 """
 def makeTeamFolders(prod_):
     team_folder = getProduction(prod_)['teams']
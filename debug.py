@@ -34,7 +34,8 @@ class FileError(BaseError):
         0: 'Scene backup folder not found or could not be created.',
         1: '',
         2: 'Your scene file name is invalid.  Must be name.#.c4d or name.c4d',
-        3: 'Could not create one or more project folders.'
+        3: 'Could not create one or more project folders.',
+        4: 'The last backup of this scene is still being copied, so the scene was not saved. Wait a moment and save again.'
     }
 
 class UIError(BaseError):
@@ -51,7 +52,8 @@ class PipelineError(BaseError):
         1: 'Error validating scene metadata. Did you modify the __SCENE__ tag or rename the C4D file without using the pipeline tool?',
         2: 'Existing __SCENE__ object found. This command is intended to be run on a clean scene.',
         3: 'Could not load project data from database. Is this scene saved on the network in a project folder?',
-        4: 'This operation is only permitted to create children of top-level RenderData.'
+        4: 'This operation is only permitted to create children of top-level RenderData.',
+        5: 'This scene\'s metadata was written by a newer version of the pipeline tools. Update your tools and try again.'
     }
 
 class DatabaseError(BaseError):
@@ -59,7 +61,8 @@ class DatabaseError(BaseError):
         0: 'Master project database not found.',
         1: 'Production not found in database.',
         2: 'Team not found in production database.',
-        3: 'Invalid parameter in settings database.'
+        3: 'Invalid parameter in settings database.',
+        4: 'SQLite is not available in this Python install. Use the JSON database backend instead.'
     }
 
 def warning(message, info=''):
@@ -0,0 +1,586 @@
+# coding: UTF-8
+
+# Filesystem utilities for ESPN Animation projects pipeline
+#    - Directory listings go through scandir where it's available, which returns each entry's type
+#      with the listing itself (one round trip to the server instead of one stat per entry.) NOTE:
+#      C4D's Python 2.7 has no built-in scandir, so unless the scandir package is installed listings
+#      on Windows call FindFirstFileW directly (which also returns each entry's type & stats.) Only
+#      elsewhere do listings without scandir still cost a stat per entry.
+#    - Every listing / stat made through this module is counted, so that operations against the
+#      NAS can be measured with getCounters().
+#    - Copies are hashed as they're written, and written to a (uniquely named) temporary file that
+#      only replaces the destination once it has been verified.
+
+import errno
+import hashlib
+import os
+import os.path
+import shutil
+import stat
+import threading
+import time
+import uuid
+import Queue
+# scandir is built into Python 3.5+, and available as a package for Python 2.7
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+_counters = {'scandir': 0, 'listdir': 0, 'stat': 0, 'read': 0, 'write': 0}
+BLOCKSIZE = 1024 * 1024
+_counter_lock = threading.Lock()
+
+def _count(key, n=1):
+    with _counter_lock:
+        _counters[key] += n
+
+def getCounters():
+    ''' Returns the number of directory listings and stat calls made through this module, and the
+    number of bytes read & written by its hashing and copying. '''
+    with _counter_lock:
+        return dict(_counters)
+
+def resetCounters():
+    with _counter_lock:
+        for k in _counters:
+            _counters[k] = 0
+
+# LISTINGS #########################################################################################
+def _findFiles(path):
+    ''' Private. Lists a directory on Windows without scandir: FindFirstFileW returns each entry's
+    attributes, size and modification time with the listing, like scandir does. Returns a list of
+    (name, is_dir, size, mtime) tuples. '''
+    import ctypes
+    from ctypes import wintypes
+    kernel32 = ctypes.windll.kernel32
+    kernel32.FindFirstFileW.restype = wintypes.HANDLE
+    data    = wintypes.WIN32_FIND_DATAW()
+    handle  = kernel32.FindFirstFileW(unicode(os.path.join(path, '*')), ctypes.byref(data))
+    if (handle == None) or (handle == wintypes.HANDLE(-1).value):
+        raise OSError(ctypes.GetLastError(), 'Could not list', path)
+    entries = []
+    try:
+        while True:
+            name = data.cFileName
+            if not (name == u'.') and not (name == u'..'):
+                # FILETIME counts 100ns intervals since 1601
+                ticks = (data.ftLastWriteTime.dwHighDateTime << 32) + data.ftLastWriteTime.dwLowDateTime
+                entries.append((
+                    name if isinstance(path, unicode) else name.encode('mbcs'),
+                    bool(data.dwFileAttributes & 0x10), # FILE_ATTRIBUTE_DIRECTORY
+                    (data.nFileSizeHigh << 32) + data.nFileSizeLow,
+                    ticks / 10000000.0 - 11644473600.0
+                    ))
+            if not kernel32.FindNextFileW(handle, ctypes.byref(data)):
+                break
+    finally:
+        kernel32.FindClose(handle)
+    return entries
+
+def listDir(path):
+    ''' Lists a directory. Returns a list of (name, is_dir) tuples. '''
+    if (scandir):
+        _count('scandir')
+        entries = []
+        for entry in scandir(path):
+            # is_dir() only costs a stat if the server didn't return the entry type
+            entries.append((entry.name, entry.is_dir()))
+        return entries
+
+    _count('listdir')
+    if (os.name == 'nt'):
+        return [(name, is_dir) for name, is_dir, size, mtime in _findFiles(path)]
+    entries = []
+    for name in os.listdir(path):
+        _count('stat')
+        entries.append((name, os.path.isdir(os.path.join(path, name))))
+    return entries
+
+def listFileStats(path):
+    ''' Lists the files in a directory with their stats. Returns a list of (name, size, mtime). On
+    Windows, the stats come with the listing itself. '''
+    files = []
+    if (scandir):
+        _count('scandir')
+        for entry in scandir(path):
+            if not entry.is_dir():
+                stat = entry.stat()
+                files.append((entry.name, stat.st_size, stat.st_mtime))
+        return files
+
+    _count('listdir')
+    if (os.name == 'nt'):
+        return [(name, size, mtime) for name, is_dir, size, mtime in _findFiles(path) if not is_dir]
+    for name in os.listdir(path):
+        _count('stat')
+        full_path = os.path.join(path, name)
+        if not os.path.isdir(full_path):
+            stat = os.stat(full_path)
+            files.append((name, stat.st_size, stat.st_mtime))
+    return files
+
+def listSubdirs(path):
+    ''' Returns a sorted list of the names of all folders in a directory. '''
+    return sorted(name for name, is_dir in listDir(path) if is_dir)
+
+def getMtime(path):
+    ''' Returns the modification time of a path (None if it doesn't exist.) A folder's mtime changes
+    whenever an entry is added, removed or renamed directly inside it. '''
+    _count('stat')
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def existing(paths):
+    ''' A batched existence check: returns the set of the passed file paths that exist, listing each
+    parent folder once instead of making one stat per path. Only names are compared, so (like
+    os.path.exists) a folder of the same name counts as existing. '''
+    by_dir = {}
+    for path in paths:
+        by_dir.setdefault(os.path.dirname(path), []).append(path)
+    found = set()
+    for folder, folder_paths in by_dir.iteritems():
+        _count('listdir')
+        try:
+            files = set(os.path.normcase(name) for name in os.listdir(folder))
+        except OSError:
+            continue
+        for path in folder_paths:
+            if os.path.normcase(os.path.basename(path)) in files:
+                found.add(path)
+    return found
+
+class DirectoryCache(object):
+    ''' Caches folder listings for a time-to-live (in seconds.) An optional background thread can keep
+    every cached listing warm, so that readers never wait on the server. '''
+    def __init__(self, ttl=60.0):
+        self.ttl      = ttl
+        self._entries = {}
+        self._lock    = threading.Lock()
+        self._thread  = None
+        self._stop    = None
+
+    def get(self, path):
+        ''' Returns the sorted subfolders of a path, listing it again if the cached copy has expired.
+        Folders that can't be listed are returned as empty, and aren't cached (so an offline share is
+        listed again on the next call.) '''
+        with self._lock:
+            entry = self._entries.get(path)
+        if (entry) and (time.time() - entry[0] < self.ttl):
+            return list(entry[1])
+        return list(self.refresh(path))
+
+    def refresh(self, path):
+        ''' Re-lists a path and updates the cache. '''
+        try:
+            subdirs = listSubdirs(path)
+        except OSError:
+            with self._lock:
+                self._entries.pop(path, None)
+            return []
+        with self._lock:
+            self._entries[path] = (time.time(), subdirs)
+        return subdirs
+
+    def invalidate(self, path=None):
+        with self._lock:
+            if (path == None):
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def startRefresher(self, interval=None):
+        ''' Starts a daemon thread that re-lists every cached path each interval (defaults to the
+        ttl.) '''
+        if (self._thread) and (self._thread.is_alive()):
+            return self._thread
+        interval = interval or self.ttl
+        # every thread gets its own event, so a thread that's still sleeping after stopRefresher()
+        # can't be revived by the next startRefresher()
+        stop = self._stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                with self._lock:
+                    paths = self._entries.keys()
+                for path in paths:
+                    self.refresh(path)
+
+        self._thread = threading.Thread(target=run, name='DirectoryCacheRefresher')
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
+
+    def stopRefresher(self):
+        if (self._stop):
+            self._stop.set()
+        self._stop   = None
+        self._thread = None
+
+# HASHING & COPYING ################################################################################
+def hashFile(path, algorithm='md5'):
+    ''' Returns the hex digest of a file's contents. '''
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as stream:
+        while True:
+            block = stream.read(BLOCKSIZE)
+            if not (block):
+                break
+            _count('read', len(block))
+            digest.update(block)
+    return digest.hexdigest()
+
+def sameFile(src, dst, algorithm='md5'):
+    ''' True if dst exists with the same size and contents as src. Sizes are compared first, so
+    files that differ in size are never read. '''
+    try:
+        if not (os.path.getsize(src) == os.path.getsize(dst)):
+            return False
+    except OSError:
+        return False
+    return hashFile(src, algorithm) == hashFile(dst, algorithm)
+
+def tempPath(dst):
+    ''' Returns a unique temporary path next to dst (unique per call, so concurrent writers -- other
+    threads, or other workstations -- never share a temporary file.) The file isn't created. '''
+    return '{0}.{1}.{2}.tmp'.format(dst, os.getpid(), uuid.uuid4().hex[:12])
+
+def fileId(path):
+    ''' Returns an id that's the same for every path to one file (i.e. every hard link to it, and
+    symbolic links that resolve to it.) Python 2.7's st_ino is always 0 on Windows, so the volume
+    serial number and file index are read with GetFileInformationByHandle there. Raises OSError if
+    the file can't be opened. '''
+    _count('stat')
+    if not (os.name == 'nt'):
+        info = os.stat(path)
+        return (info.st_dev, info.st_ino)
+
+    import ctypes
+    from ctypes import wintypes
+
+    class BY_HANDLE_FILE_INFORMATION(ctypes.Structure):
+        _fields_ = [
+            ('dwFileAttributes', wintypes.DWORD),
+            ('ftCreationTime', wintypes.FILETIME),
+            ('ftLastAccessTime', wintypes.FILETIME),
+            ('ftLastWriteTime', wintypes.FILETIME),
+            ('dwVolumeSerialNumber', wintypes.DWORD),
+            ('nFileSizeHigh', wintypes.DWORD),
+            ('nFileSizeLow', wintypes.DWORD),
+            ('nNumberOfLinks', wintypes.DWORD),
+            ('nFileIndexHigh', wintypes.DWORD),
+            ('nFileIndexLow', wintypes.DWORD)
+            ]
+
+    kernel32 = ctypes.windll.kernel32
+    kernel32.CreateFileW.restype = wintypes.HANDLE
+    # no access rights are needed to read a file's information; share everything so open files work
+    handle = kernel32.CreateFileW(unicode(path), 0, 0x1 | 0x2 | 0x4, None, 3, 0x02000000, None)
+    if (handle == None) or (handle == wintypes.HANDLE(-1).value):
+        raise OSError(ctypes.GetLastError(), 'Could not open', path)
+    try:
+        info = BY_HANDLE_FILE_INFORMATION()
+        if not kernel32.GetFileInformationByHandle(handle, ctypes.byref(info)):
+            raise OSError(ctypes.GetLastError(), 'Could not read file information', path)
+    finally:
+        kernel32.CloseHandle(handle)
+    return (info.dwVolumeSerialNumber, (info.nFileIndexHigh << 32) + info.nFileIndexLow)
+
+def makeWritable(path):
+    ''' Clears a file's read-only flag (if it exists.) On Windows a read-only file can't be removed
+    or replaced. Note that this applies to every hard link to the file. '''
+    try:
+        os.chmod(path, stat.S_IREAD | stat.S_IWRITE | stat.S_IRGRP | stat.S_IROTH)
+    except OSError:
+        pass
+
+def _remove(path):
+    ''' Private. Removes a temporary copy after a failed write, even if copystat made it read-only. '''
+    if os.path.exists(path):
+        makeWritable(path)
+        os.remove(path)
+
+def replace(src, dst):
+    ''' Renames src over dst. On Windows, os.rename can't replace an existing file, so MoveFileExW
+    (MOVEFILE_REPLACE_EXISTING) is used instead: dst is replaced in one step, and readers never find
+    it missing. '''
+    if (os.name == 'nt'):
+        import ctypes
+        # MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst), 0x1 | 0x8):
+            raise OSError(ctypes.GetLastError(), 'Could not replace', dst)
+    else:
+        os.rename(src, dst)
+
+def renameNew(src, dst):
+    ''' Renames src to dst, raising OSError (EEXIST) if dst exists instead of replacing it. The check
+    is made by the rename itself, so two writers can't both claim dst. '''
+    if (os.name == 'nt'):
+        # os.rename never replaces on Windows
+        try:
+            os.rename(src, dst)
+        except OSError as e:
+            if os.path.exists(dst):
+                raise OSError(errno.EEXIST, 'File exists', dst)
+            raise
+    else:
+        # rename replaces silently here, but link doesn't
+        try:
+            os.link(src, dst)
+        except OSError as e:
+            if (e.errno == errno.EEXIST):
+                raise
+            # no hard links on this volume: check first instead
+            if os.path.exists(dst):
+                raise OSError(errno.EEXIST, 'File exists', dst)
+            os.rename(src, dst)
+            return
+        os.remove(src)
+
+def copyAtomic(src, dst, algorithm='md5', verify=True):
+    ''' Copies a file (with its timestamps) to a temporary file next to dst, which replaces dst once
+    it's complete (see replace.) The source is hashed as it's copied; with verify, the written copy is
+    read back and must match, otherwise the temporary file is removed and an IOError is raised.
+    Returns: (hex digest, bytes copied) '''
+    temp_path = tempPath(dst)
+    digest    = hashlib.new(algorithm)
+    size      = 0
+    try:
+        with open(src, 'rb') as src_stream:
+            with open(temp_path, 'wb') as dst_stream:
+                while True:
+                    block = src_stream.read(BLOCKSIZE)
+                    if not (block):
+                        break
+                    digest.update(block)
+                    dst_stream.write(block)
+                    size += len(block)
+        _count('read', size)
+        _count('write', size)
+        shutil.copystat(src, temp_path)
+        if (verify) and not (hashFile(temp_path, algorithm) == digest.hexdigest()):
+            raise IOError('Checksum mismatch copying {0} to {1}'.format(src, dst))
+        replace(temp_path, dst)
+    except:
+        _remove(temp_path)
+        raise
+    return (digest.hexdigest(), size)
+
+def copyFile(src, dst, overwrite=True):
+    ''' Copies a file through a temporary file and a rename, so dst is never seen half-written. On
+    Windows this uses CopyFileW, which lets an SMB server copy the file itself (server-side copy)
+    instead of sending the data through this machine. Without overwrite, an OSError (EEXIST) is
+    raised if dst exists when the copy is moved into place. Returns the size of the copy. '''
+    temp_path = tempPath(dst)
+    try:
+        if (os.name == 'nt'):
+            import ctypes
+            if not ctypes.windll.kernel32.CopyFileW(unicode(src), unicode(temp_path), False):
+                raise OSError(ctypes.GetLastError(), 'Could not copy', src)
+        else:
+            shutil.copy2(src, temp_path)
+        size = os.path.getsize(temp_path)
+        if not (size == os.path.getsize(src)):
+            raise IOError('Incomplete copy of {0} to {1}'.format(src, dst))
+        _count('write', size)
+        if (overwrite):
+            replace(temp_path, dst)
+        else:
+            renameNew(temp_path, dst)
+    except:
+        _remove(temp_path)
+        raise
+    return size
+
+def link(src, dst, mode='hardlink'):
+    ''' Materializes src at dst as a 'hardlink', 'symlink' or (verified) 'copy'. Python 2.7 has no
+    os.link / os.symlink on Windows, so the Win32 calls are used there. If a link can't be made (e.g.
+    across volumes, or without the symlink privilege) the file is copied instead.
+    Returns: the mode actually used. '''
+    temp_path = tempPath(dst)
+    if (mode == 'hardlink') or (mode == 'symlink'):
+        try:
+            _link(src, temp_path, mode)
+        except (OSError, AttributeError):
+            mode = 'copy'
+    if (mode == 'copy'):
+        copyAtomic(src, dst)
+        return mode
+    try:
+        replace(temp_path, dst)
+    except:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        raise
+    return mode
+
+def _link(src, dst, mode):
+    ''' Private. Makes a hard or symbolic link, raising OSError on failure. '''
+    if (os.name == 'nt'):
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        if (mode == 'hardlink'):
+            ok = kernel32.CreateHardLinkW(unicode(dst), unicode(src), None)
+        else:
+            ok = kernel32.CreateSymbolicLinkW(unicode(dst), unicode(src), 0)
+        if not (ok):
+            raise OSError(ctypes.GetLastError(), 'Could not link', dst)
+    elif (mode == 'hardlink'):
+        os.link(src, dst)
+    else:
+        os.symlink(os.path.abspath(src), dst)
+
+# THREAD POOL ######################################################################################
+def parallel(func, items, workers=4, callback=None):
+    ''' Calls func on every item on a bounded pool of daemon threads (for I/O-bound work; the c4d
+    API must not be used from func.) callback(item, result) is called on the calling thread as each
+    item finishes. Returns the results in the order of items. The first exception raised by func is
+    re-raised once all the items are done. '''
+    items   = list(items)
+    results = [None] * len(items)
+    if not (items):
+        return results
+    todo    = Queue.Queue()
+    done    = Queue.Queue()
+    for i in xrange(len(items)):
+        todo.put(i)
+
+    def run():
+        while True:
+            try:
+                i = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                done.put((i, func(items[i]), None))
+            except Exception as e:
+                done.put((i, None, e))
+
+    threads = []
+    for n in xrange(max(1, min(workers, len(items)))):
+        thread = threading.Thread(target=run, name='FilesystemWorker')
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    error = None
+    for n in xrange(len(items)):
+        i, result, e = done.get()
+        results[i] = result
+        if (e) and (error == None):
+            error = e
+        if (callback) and not (e):
+            callback(items[i], result)
+    for thread in threads:
+        thread.join()
+    if (error):
+        raise error
+    return results
+
+# FOLDER TREES #####################################################################################
+class FolderPlan(object):
+    ''' A folder template compiled into the folders it describes, parent-first. A template is a dict
+    of {folder: subfolders}, where subfolders is a list of folder names, a nested template, or a list
+    mixing both -- to any depth.
+    paths: every relative folder path (as a tuple of names), parents before their children.
+    levels: the same paths grouped by depth. '''
+    def __init__(self, template):
+        self.paths  = []
+        self._compile(template, ())
+        self.paths.sort(key=lambda path: (len(path), path))
+        self.levels = []
+        for path in self.paths:
+            if (len(self.levels) < len(path)):
+                self.levels.append([])
+            self.levels[len(path) - 1].append(path)
+
+    def _compile(self, node, parent):
+        if isinstance(node, dict):
+            for name, sub in node.iteritems():
+                self.paths.append(parent + (name,))
+                self._compile(sub, parent + (name,))
+        elif isinstance(node, (list, tuple)):
+            for sub in node:
+                self._compile(sub, parent)
+        elif (node):
+            self.paths.append(parent + (node,))
+
+_plans = {}
+
+def compileTree(template):
+    ''' Gets the (cached) FolderPlan of a template. '''
+    entry = _plans.get(id(template))
+    if (entry == None) or not (entry[0] is template):
+        entry = (template, FolderPlan(template))
+        _plans[id(template)] = entry
+    return entry[1]
+
+def buildTree(root, template, workers=4):
+    ''' Makes the root folder and every folder of a template below it. What already exists is found
+    with one listing per existing planned folder; the missing folders are made one level at a time
+    (parents first), each level on a small thread pool.
+    Returns: {'root': str, 'created': [paths], 'existing': [paths], 'failed': [(path, error)]}. The
+    folders below a folder that couldn't be made are failed with their parent's error. '''
+    plan   = compileTree(template)
+    result = {'root': root, 'created': [], 'existing': [], 'failed': []}
+
+    # everything that already exists, from one recursive listing of the planned folders
+    existing = set()
+    if (getMtime(root) == None):
+        try:
+            os.makedirs(root)
+            result['created'].append(root)
+        except OSError as e:
+            result['failed'].append((root, e))
+            result['failed'] += [(os.path.join(root, *path), e) for path in plan.paths]
+            return result
+    else:
+        planned = set(plan.paths)
+        stack   = [()]
+        while (stack):
+            parent = stack.pop()
+            try:
+                entries = listDir(os.path.join(root, *parent))
+            except OSError:
+                continue
+            for name, is_dir in entries:
+                path = parent + (name,)
+                if (is_dir) and (path in planned):
+                    existing.add(path)
+                    stack.append(path)
+
+    def make(path):
+        try:
+            os.mkdir(path)
+        except OSError as e:
+            # another machine may have made it in the meantime
+            if not os.path.isdir(path):
+                return e
+        return None
+
+    # {path: error} of the folders that couldn't be made (or were skipped because a parent wasn't)
+    failed = {}
+    for level in plan.levels:
+        todo = []
+        for path in level:
+            if (path in existing):
+                result['existing'].append(os.path.join(root, *path))
+            elif (path[:-1] in failed):
+                failed[path] = failed[path[:-1]]
+                result['failed'].append((os.path.join(root, *path), failed[path]))
+            else:
+                todo.append(path)
+        errors = parallel(make, [os.path.join(root, *path) for path in todo], workers=workers)
+        for path, error in zip(todo, errors):
+            full_path = os.path.join(root, *path)
+            if (error):
+                failed[path] = error
+                result['failed'].append((full_path, error))
+            else:
+                result['created'].append(full_path)
+    return result
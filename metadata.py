@@ -0,0 +1,182 @@
+# coding: UTF-8
+
+# Scene metadata for ESPN Animation projects pipeline
+#    - The metadata of a pipeline scene lives in the SCENE_DATA annotation tag on its __SCENE__ null.
+#      It's stored as compact JSON carrying a schema version; the original "Key: value" text format
+#      is still read, and is replaced with JSON the next time the scene's metadata is written.
+#    - Saving a pipeline scene also writes its metadata to a small JSON sidecar next to the .c4d file
+#      (see SIDECAR), stamped with the scene file's size and mtime. Batch tools read the metadata of
+#      saved scenes from their sidecars, and only load a scene (objects only -- no materials,
+#      textures or render settings) when its sidecar is missing or out of date.
+
+import json
+import os.path
+# internal libraries
+import c4d
+# custom libraries
+from espntools import debug
+from espntools import filesystem
+
+SCHEMA  = 1
+HOOK    = '__SCENE__'
+TAG     = 'SCENE_DATA'
+# the sidecar of a scene file: scene.c4d -> scene.c4d.meta
+SIDECAR = '{0}.meta'
+# field name: type
+FIELDS  = [
+    ('production', str),
+    ('project_name', str),
+    ('scene_name', str),
+    ('framerate', int),
+    ('version', int)
+    ]
+# the legacy text keys of each field
+LEGACY  = {
+    'Production': 'production',
+    'Project': 'project_name',
+    'Scene': 'scene_name',
+    'Framerate': 'framerate',
+    'Version': 'version'
+    }
+
+def encode( data ):
+    ''' Serializes a dictionary of metadata fields (see FIELDS) to the text stored in the tag. '''
+    record = _validate(data)
+    record['schema'] = SCHEMA
+    return json.dumps(record, sort_keys=True, separators=(',', ':'))
+
+def decode( text, alert=False ):
+    ''' Parses the text of a scene's metadata tag (JSON, or the legacy text format) into a dictionary
+    of fields. Raises debug.PipelineError if the metadata is missing fields, invalid, or was written
+    by a newer version of the schema (only alerting the user if alert is passed.) '''
+    text = (text or '').strip()
+    try:
+        if text.startswith('{'):
+            record = json.loads(text)
+            if (record.get('schema', 0) > SCHEMA):
+                raise debug.PipelineError(5, alert=alert)
+        else:
+            record = _decodeLegacy(text)
+        return _validate(record)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise debug.PipelineError(1, alert=alert)
+
+def _decodeLegacy( text ):
+    ''' Private. Reads the original "Key: value" lines. Only the first ':' of a line separates the key,
+    so values (e.g. scene names) may contain colons. '''
+    record = {}
+    for line in text.split('\n'):
+        if not (line.strip()):
+            continue
+        key, value = line.split(':', 1)
+        record[LEGACY[key.strip()]] = value.strip()
+    return record
+
+def _validate( record ):
+    ''' Private. Checks that every field is present, and coerces it to its type. '''
+    data = {}
+    for field, typ in FIELDS:
+        value = record[field]
+        if (typ == int):
+            data[field] = int(value)
+        elif isinstance(value, unicode):
+            data[field] = value.encode('utf-8')
+        elif isinstance(value, str):
+            data[field] = value
+        else:
+            raise TypeError(field)
+    return data
+
+# SAVED SCENES ####################################################################################
+def findTag( doc ):
+    ''' Returns the metadata tag of a document (the hook is always a top-level object), or None. '''
+    obj = doc.GetFirstObject()
+    while (obj):
+        if (obj.GetName() == HOOK):
+            tag = obj.GetFirstTag()
+            while (tag):
+                if (tag.GetType() == c4d.Tannotation) and (tag.GetName() == TAG):
+                    return tag
+                tag = tag.GetNext()
+        obj = obj.GetNext()
+    return None
+
+def writeSidecar( path, data ):
+    ''' Writes the sidecar of a saved scene file (call after the scene is saved.) Returns False if it
+    couldn't be written. '''
+    record = _validate(data)
+    record['schema'] = SCHEMA
+    sidecar = SIDECAR.format(path)
+    temp_path = filesystem.tempPath(sidecar)
+    try:
+        info = os.stat(path)
+        record['scene'] = [info.st_size, info.st_mtime]
+        with open(temp_path, 'w') as stream:
+            json.dump(record, stream, sort_keys=True, separators=(',', ':'))
+        filesystem.replace(temp_path, sidecar)
+    except (IOError, OSError) as e:
+        debug.warning('Could not write scene metadata sidecar', '{0} ({1})'.format(sidecar, e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+    return True
+
+def readSidecar( path ):
+    ''' Reads the metadata of a saved scene from its sidecar. Returns a dictionary of fields, or None
+    if the sidecar is missing, unreadable, or older than the scene file. '''
+    try:
+        with open(SIDECAR.format(path), 'r') as stream:
+            record = json.load(stream)
+        info = os.stat(path)
+    except (IOError, OSError, ValueError):
+        return None
+    if not (record.get('scene') == [info.st_size, info.st_mtime]) or (record.get('schema', 0) > SCHEMA):
+        return None
+    try:
+        return _validate(record)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def readFile( path ):
+    ''' Reads the metadata of a saved scene: from its sidecar if it's current, otherwise by loading
+    only the scene's objects (not its materials or render settings.) Returns a dictionary of fields
+    (plus 'path'), or None if it isn't a pipeline scene. '''
+    data = readSidecar(path)
+    if (data):
+        data['path'] = path
+        return data
+    doc = c4d.documents.LoadDocument(path, c4d.SCENEFILTER_OBJECTS)
+    if (doc == None):
+        raise IOError('Could not load scene: {0}'.format(path))
+    try:
+        tag = findTag(doc)
+        if (tag == None):
+            return None
+        data = decode(tag[c4d.ANNOTATIONTAG_TEXT])
+        data['path'] = path
+        return data
+    finally:
+        c4d.documents.KillDocument(doc)
+
+def readFiles( paths, sort=True ):
+    ''' Reads the metadata of many saved scenes. Scenes that can't be read, or aren't pipeline scenes,
+    are skipped. Returns a list of dictionaries (see readFile), sorted by production, project, scene
+    and version. '''
+    records = []
+    for path in paths:
+        try:
+            data = readFile(path)
+        except (IOError, debug.PipelineError):
+            debug.warning('Could not read scene metadata', path)
+            continue
+        if (data):
+            records.append(data)
+    if (sort):
+        records.sort(key=lambda d: (d['production'], d['project_name'], d['scene_name'], d['version']))
+    return records
+
+def readFolder( folder, sort=True ):
+    ''' Reads the metadata of every .c4d scene in a folder. '''
+    paths = [os.path.join(folder, name) for name, is_dir in sorted(filesystem.listDir(folder))
+             if not (is_dir) and name.lower().endswith('.c4d')]
+    return readFiles(paths, sort=sort)
@@ -0,0 +1,132 @@
+# coding: UTF-8
+
+# Path templates for ESPN Animation projects pipeline
+#    - Every path the pipeline builds for a scene (scene file, backup folder, render & multipass
+#      outputs) comes from a template. A production can override any of the TEMPLATES with a
+#      'path_templates' record in the database.
+#    - Templates use str.format fields. They're parsed and validated once, when first used, and then
+#      formatted directly.
+#    - Besides the fields below, every folder in the production's 'folder_lookup' is available as a
+#      field (already formatted for the project), e.g. {render_3d} or {c4d_backup}. Only the folders
+#      the templates use are formatted.
+#    - A template or folder that can't be formatted logs a warning and raises DatabaseError(3)
+#      without an alert: callers report it in their own terms (e.g. MetaScene raises FileError.)
+
+import collections
+import os.path
+import string
+# custom libraries
+from espntools import database
+from espntools import debug
+
+TEMPLATES = {
+    'scene': '{c4d_project}/{project}_{scene}.c4d',
+    'backup': '{c4d_backup}',
+    'render': '{render_3d}/{scene}/v{version:03d}/{take}/{scene}_{take}',
+    'multipass': '{render_3d}/{scene}/v{version:03d}/{take}_passes/{scene}_{take}'
+    }
+# fields available to every template
+TOKENS = ['production', 'project', 'scene', 'version', 'take']
+# the take token C4D expands itself at render time
+TAKE   = '$take'
+
+class PathTemplate(object):
+    ''' A template compiled for repeated use: its fields are parsed (and validated) once. '''
+    def __init__(self, template, tokens=None):
+        self.template = template
+        self.fields   = set()
+        for literal, field, spec, conversion in string.Formatter().parse(template):
+            if (field != None):
+                self.fields.add(field.split('.')[0].split('[')[0])
+        if (tokens != None):
+            unknown = self.fields.difference(tokens)
+            if (unknown):
+                debug.warning('Unknown fields in path template', '{0} ({1})'.format(template, ', '.join(sorted(unknown))))
+                raise debug.DatabaseError(3, alert=False)
+        self._format = template.format
+
+    def __call__(self, values):
+        ''' Formats the template with a dictionary of values, returning a normalized path. '''
+        try:
+            return os.path.normpath(self._format(**values))
+        except (KeyError, ValueError):
+            debug.warning('Could not format path template', self.template)
+            raise debug.DatabaseError(3, alert=False)
+
+_compiled = {}
+
+def compileTemplate( template, tokens=None ):
+    ''' Gets the (cached) PathTemplate for a template string. '''
+    key = (template, tuple(sorted(tokens)) if (tokens != None) else None)
+    compiled = _compiled.get(key)
+    if (compiled == None):
+        compiled = _compiled[key] = PathTemplate(template, tokens)
+    return compiled
+
+def getTemplates( prod_data ):
+    ''' Returns the templates of a production record (the defaults, with any overrides.) '''
+    templates = dict(TEMPLATES)
+    templates.update(prod_data.get('path_templates', {}))
+    return templates
+
+class PathContext(object):
+    ''' The values & compiled templates to build the paths of one scene. '''
+    def __init__(self, prod_data, production, project, scene, version=1):
+        self.templates = getTemplates(prod_data)
+        self.values    = {
+            'production': production,
+            'project': project,
+            'scene': scene,
+            'version': int(version),
+            'take': TAKE
+            }
+        folders        = prod_data['folder_lookup']
+        self.tokens    = TOKENS + folders.keys()
+        used           = set()
+        for template in self.templates.itervalues():
+            used.update(compileTemplate(template, self.tokens).fields)
+        for key in used.intersection(folders):
+            try:
+                self.values[key] = folders[key].format(project)
+            except (KeyError, IndexError, ValueError):
+                debug.warning('Could not format project folder', '{0}: {1}'.format(key, folders[key]))
+                raise debug.DatabaseError(3, alert=False)
+
+    def get(self, name, **values):
+        ''' Builds a path from a template name, with optional overriding values (e.g. take, version.) '''
+        compiled = compileTemplate(self.templates[name], self.tokens)
+        if (values):
+            merged = dict(self.values)
+            merged.update(values)
+            return compiled(merged)
+        return compiled(self.values)
+
+    def expand(self, names, takes=None, versions=None):
+        ''' Builds the paths of several templates for every combination of takes and versions at once.
+        Returns: OrderedDict of {(name, take, version): path} '''
+        takes    = takes or [TAKE]
+        versions = versions or [self.values['version']]
+        compiled = [(name, compileTemplate(self.templates[name], self.tokens)) for name in names]
+        values   = dict(self.values)
+        paths    = collections.OrderedDict()
+        for version in versions:
+            values['version'] = int(version)
+            for take in takes:
+                values['take'] = take
+                for name, template in compiled:
+                    paths[(name, take, version)] = template(values)
+        return paths
+
+def forScene( scene ):
+    ''' Returns the PathContext of a MetaScene. '''
+    return PathContext(scene.prod_data, scene.production, scene.project_name, scene.scene_name,
+                       scene.version or 1)
+
+def toUNC( path, roots=None ):
+    ''' Replaces a mapped drive letter at the start of a path with its UNC root (see
+    database.__uncroots__), for machines (e.g. the render farm) that don't map the drives. '''
+    roots = roots or database.__uncroots__
+    drive = path[:2].upper()
+    if (drive in roots):
+        return roots[drive] + path[2:]
+    return path
@@ -0,0 +1,138 @@
+# coding: UTF-8
+
+# Background prefetching for ESPN Animation projects pipeline
+#    - Warms the database caches (production records, preset lists, project listings and team
+#      indexes) on a worker thread when the plug-in loads, so that the UI reads from memory instead
+#      of waiting on the NAS.
+#    - Nothing here touches the c4d API, which may only be used from the main thread.
+
+import threading
+import Queue
+# custom libraries
+from espntools import database
+from espntools import debug
+
+class Future(object):
+    ''' A thread-safe placeholder for the result of work done on another thread. '''
+    def __init__(self):
+        self._done    = threading.Event()
+        self._claimed = False
+        self._lock    = threading.Lock()
+        self._result  = None
+        self._error   = None
+
+    def claim(self):
+        ''' Returns True for exactly one caller, which is then responsible for completing the
+        future. '''
+        with self._lock:
+            if (self._claimed):
+                return False
+            self._claimed = True
+            return True
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, error):
+        self._error = error
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        ''' Blocks until the result is available (or the timeout expires, returning None.) Errors
+        raised by the work are re-raised here. '''
+        if not self._done.wait(timeout):
+            return None
+        if (self._error):
+            raise self._error
+        return self._result
+
+class PrefetchService(object):
+    ''' Warms the database for the production list and then every production, in order, on a single
+    daemon thread. Callers that need a production before the worker reaches it warm it themselves. '''
+    PRODUCTIONS = '__productions__'
+
+    def __init__(self):
+        self._futures = {}
+        self._lock    = threading.Lock()
+        self._queue   = Queue.Queue()
+        self._thread  = None
+
+    def start(self):
+        if (self._thread) and (self._thread.is_alive()):
+            return self._thread
+        self._queue.put(self.PRODUCTIONS)
+        self._thread = threading.Thread(target=self._run, name='PrefetchService')
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
+
+    def wait(self, key=PRODUCTIONS, timeout=None):
+        ''' Blocks until a production (or the production list) has been warmed, and returns its
+        result. If the worker hasn't started on it yet, it's warmed on the calling thread. '''
+        future = self._future(key)
+        if future.claim():
+            self._warm(key, future)
+        return future.result(timeout)
+
+    def _future(self, key):
+        with self._lock:
+            if not (key in self._futures):
+                self._futures[key] = Future()
+            return self._futures[key]
+
+    def _run(self):
+        while True:
+            key    = self._queue.get()
+            future = self._future(key)
+            if future.claim():
+                self._warm(key, future)
+            if (key == self.PRODUCTIONS):
+                try:
+                    productions = future.result()
+                except Exception:
+                    continue
+                for prod_ in productions:
+                    self._queue.put(prod_)
+
+    def _warm(self, key, future):
+        try:
+            if (key == self.PRODUCTIONS):
+                result = database.getAllProductions()
+            else:
+                result = {
+                    'record': database.getProduction(key),
+                    'projects': database.getAllProjects(key),
+                    'presets': database.getAllPresets(key),
+                    'teams': self._warmTeams(key)
+                    }
+            future.set_result(result)
+        except Exception as e:
+            debug.warning('Could not prefetch database', '{0} ({1})'.format(key, e))
+            # forget the failed attempt, so that the next caller tries again
+            with self._lock:
+                self._futures.pop(key, None)
+            future.set_exception(e)
+
+    def _warmTeams(self, key):
+        ''' Warms a production's team index. Productions without a (readable) team database can still
+        be used, so a failure here doesn't fail the production. '''
+        try:
+            return database.getTeamIndex(key)
+        except Exception as e:
+            debug.warning('Could not prefetch team database', '{0} ({1})'.format(key, e))
+            return None
+
+_service = PrefetchService()
+
+def start():
+    ''' Starts prefetching the database, and keeps project listings warm in the background. '''
+    database.startProjectRefresher()
+    return _service.start()
+
+def wait(prod_=None, timeout=None):
+    ''' Waits for a production (or, if none is passed, the production list) to be prefetched. '''
+    return _service.wait(prod_ or PrefetchService.PRODUCTIONS, timeout)
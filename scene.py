@@ -3,14 +3,26 @@
 # built-in libraries
 from os import makedirs
 from functools import wraps
+import collections
 import os.path
 # c4d libraries
 import c4d
 from c4d import gui
 # custom libraries
+from espntools import backup
 from espntools import core
 from espntools import database
 from espntools import debug
+from espntools import filesystem
+from espntools import metadata
+from espntools import paths
+from espntools import symbols
+from espntools import traverse
+
+# A lightweight, immutable copy of the metadata fields of a MetaScene (see MetaScene.snapshot)
+Snapshot = collections.namedtuple('Snapshot', [field for field, typ in metadata.FIELDS])
+# the fields the scene's file & backup paths are built from
+PATH_FIELDS = ('production', 'project_name', 'scene_name', 'version')
 
 class MetaScene(object):
     ''' MetaScene is an mapper / wrapper for scene files in Cinema 4D's Python API. It consists of convenience functions
@@ -23,7 +35,12 @@ class MetaScene(object):
     The "real" scene (i.e. a c4d.BaseDocument object) is the target of most operations.
     The internal naming convention is careful to distinguish these two entities (i.e. "vscene" and "rscene".)
 
-    The JSON databases are currently static, and therefore the mapping is effectively unidirectional. '''
+    The JSON databases are currently static, and therefore the mapping is effectively unidirectional.
+
+    Synchronization is incremental: the scene keeps a snapshot of the fields as they were last pulled from
+    (or pushed to) the real scene, so pushes are skipped when nothing changed, pulls are skipped while the
+    metadata tag is untouched, and production data & paths are only rebuilt when the fields they come
+    from change. '''
 
     production   = ''
     project_name = ''
@@ -38,10 +55,19 @@ class MetaScene(object):
     previous     = None
 
     ### Constructors
-    def __init__(self, null=False):
+    def __init__(self, null=False, alert=False):
+        ''' null: don't read the active scene's metadata.
+        alert: alert the user if the metadata is invalid (for interactive use.) '''
+        self._synced     = None
+        self._tag_dirty  = None
+        self._prod_key   = None
+        self._paths      = None
+        self._paths_key  = None
+        self._doc_dirty  = None
+        # invalid hooks found by the last search (see _clr_rscene_hook)
+        self.cleanup     = []
         if (self.is_tagged()) and not (null):
-            self._get_rscene_data()
-            self._set_vscene_path()
+            self._get_rscene_data(alert=alert)
         #self.is_sync()
 
     def __repr__(self):
@@ -81,16 +107,17 @@ class MetaScene(object):
         this_scene.framerate    = data['framerate']
         this_scene.version      = data['version']
 
-        this_scene.prod_data    = database.getProduction(this_scene.production)
+        this_scene._get_prod_data()
 
-        this_scene._bld_rscene_hook()
-        this_scene._set_rscene_data()
-        this_scene._set_vscene_path()
-        this_scene._bld_project_dir()
+        with core.transaction():
+            this_scene._bld_rscene_hook()
+            this_scene._set_rscene_data()
+            this_scene._set_vscene_path()
+            this_scene._bld_project_dir()
 
-        if (set_rdata):  this_scene._set_rscene_renderdata()
-        if (set_output): this_scene._set_rscene_output_paths()
-        if (set_frate):  this_scene._set_rscene_framerate()
+            if (set_rdata):  this_scene._set_rscene_renderdata()
+            if (set_output): this_scene._set_rscene_output_paths()
+            if (set_frate):  this_scene._set_rscene_framerate()
         if (save):       this_scene.save()
         
         return this_scene
@@ -106,61 +133,82 @@ class MetaScene(object):
         return True
 
     ## Push/pull synchronization operations
-    def pull_from_scene(self):
-        self._get_rscene_hook()
-        self._get_rscene_data()
-        self._set_vscene_path()
-        return True
+    def snapshot(self):
+        ''' Returns a lightweight copy of the metadata fields (see Snapshot.) '''
+        return Snapshot(self.production, self.project_name, self.scene_name, self.framerate, self.version)
+
+    def changed(self, since=None):
+        ''' Returns the names of the fields that differ from a snapshot (by default, the state of the real
+        scene as of the last push or pull.) Every field has changed if the scene was never synchronized. '''
+        since = since or self._synced
+        if (since == None):
+            return list(Snapshot._fields)
+        current = self.snapshot()
+        return [field for field in Snapshot._fields if not (getattr(current, field) == getattr(since, field))]
+
+    def pull_from_scene(self, alert=False):
+        ''' Reads the metadata from the real scene, if its tag was modified since the last push or pull.
+        Returns: bool (whether the virtual scene was updated.) Raises debug.PipelineError for invalid
+        metadata (once -- it isn't read again until the tag is modified.) '''
+        if (self._tag_alive()):
+            if (self.scene_tag.GetDirty(c4d.DIRTYFLAGS_DATA) == self._tag_dirty):
+                return False
+        else:
+            # untagged scenes are only searched again once the document itself has changed
+            doc   = c4d.documents.GetActiveDocument()
+            dirty = (doc, doc.GetDirty(c4d.DIRTYFLAGS_DATA | c4d.DIRTYFLAGS_CHILDREN))
+            if (dirty == self._doc_dirty):
+                return False
+            searched = (self._doc_dirty != None) and (self._doc_dirty[0] == doc)
+            self._doc_dirty = dirty
+            # once a document has been searched, edits are only checked for a hook at the top level
+            # (where _bld_rscene_hook inserts it): a full search would rebuild the document's index
+            # after every edit of an untagged scene
+            if (searched) and not (_topLevelHook(doc)):
+                return False
+            if not (self.is_tagged()):
+                return False
+        try:
+            return self._get_rscene_data(alert=alert)
+        except debug.PipelineError:
+            # don't report the same invalid metadata again until the tag is modified
+            self._tag_dirty = self.scene_tag.GetDirty(c4d.DIRTYFLAGS_DATA)
+            raise
 
     def push_to_scene(self):
-        self._get_rscene_hook()
-        self._set_rscene_data()
-        self._set_vscene_path()
+        ''' Writes the metadata to the real scene, if any field changed since the last push or pull (see
+        changed() for which fields will be written.) Returns: True. '''
+        if (self.changed()):
+            self._set_rscene_data()
+            self._set_vscene_path()
         return True
 
-    def save(self):
-        ''' Save the active scene and make a backup. '''
-        def increment(filename):
-            ''' This function takes a valid backup file-name and searches the destination folder for the 
-            next valid version increment.  Note this is a fairly 'dumb' process, but ensures that a 
-            particular backup is never overwriting an existing one. '''
-            if not os.path.exists(filename):
-                return filename
-
-            file_path = os.path.dirname(filename)
-            file_name = os.path.basename(filename)
-            file_name = file_name.split('.')
-            name      = file_name[0]
-            ext       = file_name[len(file_name)-1]
-
-            if len(file_name) == 2:
-                cur_vers = 1
-            elif len(file_name) == 3:
-                cur_vers = int(file_name[1])+1
-            else:
-                raise debug.FileError(2)
-
-            incr_name = "{0}.{1}.{2}".format(name, str(cur_vers).zfill(4), ext)
-            incr_file = os.path.join(file_path, incr_name)
-
-            if os.path.exists(incr_file):
-                incr_file = increment(incr_file)
-            return incr_file
-
-        # validate before running
-        backup_file  = os.path.join(self.backup_folder, self.file_name)
-        backup_path  = increment(backup_file)
-
-        if not os.path.exists(self.backup_folder):
+    def save(self, background=True):
+        ''' Save the active scene and make a backup. The scene is only written once: the backup is a
+        copy of the saved file, made in the background (unless background is False.) Raises
+        FileError(4) without saving if the last backup of the scene is still being copied. '''
+        # don't rewrite the scene file while its last backup is still being copied from it (but don't
+        # hang C4D on a stalled copy either -- the save is refused, and can be retried)
+        if not backup.wait(self.file_path, timeout=backup.WAIT_TIMEOUT):
+            raise debug.FileError(4)
+
+        # the backup name is taken once the last copy has finished, from one cached listing of the
+        # folder (copyBackup reserves it, moving on to the next free version if it's been taken)
+        backups      = backup.getIndex(self.backup_folder)
+        backup_path  = backups.next(self.file_name)
+
+        if not (backups.exists):
             makedirs(self.backup_folder)
         if not os.path.exists(self.file_folder):
             makedirs(self.file_folder)
-
         try:
-            core.saveAs(backup_path)
             core.saveAs(self.file_path)
         except debug.FileError:
             raise debug.FileError(0)
+        # batch tools read the metadata of saved scenes from this, instead of loading them
+        metadata.writeSidecar(self.file_path, self.snapshot()._asdict())
+        return backup.copyBackup(self.file_path, backup_path, background=background,
+            policy=backup.getPolicy(self.prod_data))
 
     def rename(self, name=None):
         ''' Rename the active scene without moving it to a new project folder.'''
@@ -188,6 +236,7 @@ class MetaScene(object):
         self.version = 1
         self._set_rscene_data()
         self._set_rscene_output_paths()
+        self.make_output_dirs()
         self.save()
         return True
 
@@ -196,6 +245,7 @@ class MetaScene(object):
         self.version += 1
         self._set_rscene_data()
         self._set_rscene_output_paths()
+        self.make_output_dirs()
         self.save()
         return True
 
@@ -203,18 +253,20 @@ class MetaScene(object):
     def _get_rscene_hook(self):
         ''' Checks for hooks in the active scene. Sets virtual scene status accordingly.
             Returns: (Bool, c4d.Tannotation) '''
+        self.cleanup = []
         scene_ctrl = core.ls(name='__SCENE__')
         if (scene_ctrl == None) or (scene_ctrl == []):
             return (False, None)
 
         elif (len(scene_ctrl)>1):
-            self.cleanup += scene_ctrl
+            self.cleanup = list(scene_ctrl)
             return (False, None)
 
         elif (len(scene_ctrl)==1):
-            scene_tag = core.lsTags(name='SCENE_DATA', typ=c4d.Tannotation, obj=scene_ctrl[0])
+            scene_tag = [t for t in core.lsTags(name='SCENE_DATA', typ=c4d.Tannotation)
+                         if t.GetObject() == scene_ctrl[0]]
             if not (scene_tag):
-                self.cleanup += scene_ctrl
+                self.cleanup = list(scene_ctrl)
                 return (False, None)
             else:
                 self.scene_ctrl = scene_ctrl[0]
@@ -224,61 +276,78 @@ class MetaScene(object):
             debug.warning("Unhandled exception in get_rscene_hook().")
             return (False, None)
     
-    def _get_rscene_data(self):
+    def _tag_alive(self):
+        ''' Private. Whether the attached metadata tag is still in the scene (avoids searching the scene again.) '''
+        return (self.scene_tag != None) and (self.scene_tag.IsAlive()) and (self.scene_tag.GetDocument() != None)
+
+    def _get_rscene_data(self, alert=False):
         ''' Retrieve data from active scene hooks. Populate virtual scene with that information. Performs no validation. '''
-        def tag_to_dict(tag_data):
-            ''' Takes a block of text from an annotation tag field and converts it to a dictionary.'''
-            a = tag_data.split('\n')
-            b = {}
-            for a_ in a:
-                kv = a_.split(':')
-                b[kv[0]] = kv[1].lstrip()
-            return b
-        # store a copy of the previous version of this object
-        self.previous = self
-        # parse the scene tag string into a dictionary
-        self._get_rscene_hook()
-        scene_data = tag_to_dict(self.scene_tag[c4d.ANNOTATIONTAG_TEXT])
+        # store a snapshot of the fields before the pull
+        self.previous = self.snapshot()
+        # parse the scene tag string into a dictionary (legacy text metadata is read as well)
+        if not (self._tag_alive()):
+            self._get_rscene_hook()
+        scene_data = metadata.decode(self.scene_tag[c4d.ANNOTATIONTAG_TEXT], alert=alert)
         # populate attributes from dictionary
-        self.production   = scene_data['Production']
-        self.prod_data    = database.getProduction(self.production)
-        self.project_name = scene_data['Project']
-        self.scene_name   = scene_data['Scene']
-        self.framerate    = int(scene_data['Framerate'])
-        self.version      = int(scene_data['Version'])
+        self.production   = scene_data['production']
+        self.project_name = scene_data['project_name']
+        self.scene_name   = scene_data['scene_name']
+        self.framerate    = scene_data['framerate']
+        self.version      = scene_data['version']
+        self._get_prod_data()
         self._set_vscene_path()
+        self._set_synced()
         return True
 
+    def _get_prod_data(self):
+        ''' Private. Loads the production's data from the database, unless it's already loaded. '''
+        if not (self._prod_key == self.production) or not (self.prod_data):
+            self.prod_data = database.getProduction(self.production)
+            self._prod_key = self.production
+        return self.prod_data
+
+    def _set_synced(self):
+        ''' Private. Records the fields (and the tag's dirty count) as matching the real scene. '''
+        self._synced    = self.snapshot()
+        self._tag_dirty = self.scene_tag.GetDirty(c4d.DIRTYFLAGS_DATA) if (self._tag_alive()) else None
+
+    def set_production(self, production):
+        ''' Switches the virtual scene to a production, loading its data only if it's a different production.
+        Returns: bool (whether the production changed.) '''
+        if (production == self.production) and (self._prod_key == production) and (self.prod_data):
+            return False
+        self.production = production
+        self._get_prod_data()
+        return True
+
+    def get_paths(self):
+        ''' Returns the PathContext of the scene, rebuilt only when a field the paths come from has changed. '''
+        key = tuple(getattr(self, field) for field in PATH_FIELDS) + (id(self.prod_data),)
+        if (self._paths == None) or not (key == self._paths_key):
+            self._paths     = paths.forScene(self)
+            self._paths_key = key
+        return self._paths
+
     ## Set operations (virtual scene)
     def _set_vscene_path(self):
         ''' Update internal path data for the scene when it is moved or renamed. '''
         try:
-            project_folder = self.prod_data['folder_lookup']['c4d_project'].format(self.project_name)
-        except KeyError:
+            scene_paths = self.get_paths()
+            self.file_path     = scene_paths.get('scene')
+            self.backup_folder = scene_paths.get('backup')
+        except (KeyError, debug.DatabaseError):
             debug.info('', self.prod_data)
             raise debug.FileError(1)
-        self.file_name     = '{0}_{1}.c4d'.format(self.project_name, self.scene_name)
-        #self.file_folder   = os.path.join(self.prod_data['project'], self.project_name, 'c4d')
-        self.file_folder   = self.prod_data['folder_lookup']['c4d_project'].format(self.project_name)
-        #self.backup_folder = os.path.join(self.file_folder, 'backup')
-        self.backup_folder = self.prod_data['folder_lookup']['c4d_backup'].format(self.project_name)
-        self.file_path     = os.path.join(self.file_folder, self.file_name)
+        self.file_folder   = os.path.dirname(self.file_path)
+        self.file_name     = os.path.basename(self.file_path)
 
     ## Set operations (real scene)
     def _set_rscene_data(self):
         ''' Push data from the virtual scene to the hooks in the active scene. Performs no safety check prior to running!
             save: saves the scene after setting the data. '''
-        def dict_to_tag():
-            out_str = ''
-            out_str += 'Production: {0}\n'.format(self.production)
-            out_str += 'Project: {0}\n'.format(self.project_name)
-            out_str += 'Scene: {0}\n'.format(self.scene_name)
-            out_str += 'Framerate: {0}\n'.format(self.framerate)
-            out_str += 'Version: {0}'.format(self.version)
-            return out_str
-        #
-        if (self.is_tagged()):
-            self.scene_tag[c4d.ANNOTATIONTAG_TEXT] = dict_to_tag()
+        if (self._tag_alive()) or (self.is_tagged()):
+            self.scene_tag[c4d.ANNOTATIONTAG_TEXT] = metadata.encode(self.snapshot()._asdict())
+            self._set_synced()
             return True
         else:
             return False
@@ -289,27 +358,43 @@ class MetaScene(object):
         rd  = doc.GetActiveRenderData()
         doc.SetFps(self.framerate)
         rd[c4d.RDATA_FRAMERATE] = self.framerate
-        c4d.EventAdd()
+        core.eventAdd()
         return True
 
     def _set_rscene_output_paths(self):
-        ''' Generate render output paths from metadata and sets them in the active scene. '''
-        #output_path = os.path.join( self.prod_data['project'], self.project_name, 'render_3d', self.scene_name, 'v{0}'.format(str(self.version).zfill(3)), '$take', '{0}_{1}'.format(self.scene_name, '$take') )
-        output_path = os.path.join(
-            self.prod_data['folder_lookup']['render_3d'].format(self.project_name), 
-            self.scene_name, 'v{0}'.format(str(self.version).zfill(3)), 
-            '$take', '{0}_{1}'.format(self.scene_name, '$take')
-            )
-        multi_path = os.path.join(
-            self.prod_data['folder_lookup']['render_3d'].format(self.project_name),
-            self.scene_name,
-            'v{0}'.format(str(self.version).zfill(3)),
-            '$take_passes',
-            '{0}_{1}'.format(self.scene_name, '$take')
-            )
-        core.setOutputPaths(output_path, multi_path)
+        ''' Generate render output paths from metadata and sets them in the active scene (skipped if
+        they're already set.) Returns: True. '''
+        scene_paths = self.get_paths()
+        render      = scene_paths.get('render')
+        multipass   = scene_paths.get('multipass')
+        # nothing to do (and no undo step) if the render settings already have these paths
+        rd = c4d.documents.GetActiveDocument().GetActiveRenderData()
+        if (rd[c4d.RDATA_PATH] == render) and (rd[c4d.RDATA_MULTIPASS_FILENAME] == multipass):
+            return True
+        core.setOutputPaths(render, multipass)
         return True
 
+    def make_output_dirs(self, takes=None):
+        ''' Creates the render & multipass output folders of the scene's current version for every
+        (checked) take ahead of rendering. Returns the list of folders created. '''
+        if (takes == None):
+            takes = [take.GetName() for take in core.getCheckedTakes()]
+        if not (takes):
+            # nothing checked renders the main take
+            takes = [c4d.documents.GetActiveDocument().GetTakeData().GetMainTake().GetName()]
+        expanded = self.get_paths().expand(['render', 'multipass'], takes=takes)
+        created  = []
+        for folder in sorted(set(os.path.dirname(path) for path in expanded.itervalues())):
+            if not os.path.isdir(folder):
+                try:
+                    makedirs(folder)
+                except OSError as e:
+                    # rendering makes them anyway -- this only saves the render nodes the trouble
+                    debug.warning('Could not create output folder', '{0} ({1})'.format(folder, e))
+                    continue
+                created.append(folder)
+        return created
+
     def _set_rscene_renderdata(self, preset):
         ''' Set the RenderData in the active scene to the passed production preset
             preset (str): the name of a production render preset '''
@@ -324,31 +409,24 @@ class MetaScene(object):
 
     # Private constructors & deconstructors
     def _bld_project_dir(self):
-        ''' Make a complete project directory tree for a new project. (Includes all project folders, not just C4D.)'''
-        def mk_dir(path_):
-            if not os.path.exists(path_):
-                try: 
-                    os.mkdir(path_)
-                except WindowsError: 
-                    debug.FileError(3)
-
+        ''' Make a complete project directory tree for a new project. (Includes all project folders, not just C4D.)
+        Returns the structured result of filesystem.buildTree. '''
         folder_struct = database.getFolderStructure()["PROJECT"]
         main_folder   = os.path.join(self.prod_data['folder_lookup']['animroot'], self.project_name)
 
-        print "Creating new project: " + main_folder
-        mk_dir(main_folder)
-        for main, sub in folder_struct.iteritems():
-            print "Adding: " + os.path.join(main_folder, main)
-            mk_dir(os.path.join(main_folder, main))
-            for s in sub: 
-                print "Adding: " + os.path.join(main_folder, main, s)
-                mk_dir(os.path.join(main_folder, main, s))
-        return True
+        result = filesystem.buildTree(main_folder, folder_struct)
+        debug.info('Created project folders', '{0} ({1} created, {2} already existed)'.format(
+            main_folder, len(result['created']), len(result['existing'])))
+        if (result['failed']):
+            for path, error in result['failed']:
+                debug.warning('Could not create project folder', '{0} ({1})'.format(path, error))
+            raise debug.FileError(3)
+        return result
 
     def _bld_rscene_hook(self):
         ''' Build new hooks in the active scene. Cleanup of existing hooks handled separately (see constructor method documentation.)'''
         doc = c4d.documents.GetActiveDocument()
-        doc.StartUndo()
+        core.startUndo(doc)
 
         # create null
         scene_ctrl = c4d.BaseObject(c4d.Onull)
@@ -359,8 +437,9 @@ class MetaScene(object):
         scene_tag  = core.tag(scene_ctrl, typ=c4d.Tannotation, name='SCENE_DATA')[0]
 
         doc.AddUndo(c4d.UNDOTYPE_NEW, scene_tag)
-        c4d.EventAdd()
-        doc.EndUndo()
+        core.invalidateIndex(doc)
+        core.eventAdd()
+        core.endUndo(doc)
 
         self.scene_ctrl = scene_ctrl
         self.scene_tag = scene_tag
@@ -381,74 +460,78 @@ def clearAllMultipasses():
     ''' Clear all multipass objects from the current RenderData '''
     doc = c4d.documents.GetActiveDocument()
     rdata = doc.GetActiveRenderData()
-    doc.StartUndo()
+    core.startUndo(doc)
     for mpass in core.ObjectIterator(rdata.GetFirstMultipass()):
         mpass.Remove()
-    c4d.EventAdd()
-    doc.EndUndo()
+    core.eventAdd()
+    core.endUndo(doc)
     return True
 
 def clearObjectBuffers():
     ''' Clear all object buffers from the current RenderData '''
     doc = c4d.documents.GetActiveDocument()
     rdata = doc.GetActiveRenderData()
-    doc.StartUndo()
+    core.startUndo(doc)
     for mpass in core.ObjectIterator(rdata.GetFirstMultipass()):
         if (mpass.GetTypeName() == 'Object Buffer'):
             doc.AddUndo(c4d.UNDOTYPE_DELETE, mpass)
             mpass.Remove()
-    c4d.EventAdd()
-    doc.EndUndo()
+    core.eventAdd()
+    core.endUndo(doc)
     return True
 
-def enableObjectBuffer(obid):
-    ''' Insert an object buffer into the active render data, with the passed id'''
+def enableObjectBuffer(obid, rd=None):
+    ''' Insert an object buffer into the active (or passed) render data, with the passed id'''
     doc = c4d.documents.GetActiveDocument()
-    rd = doc.GetActiveRenderData()
+    if (rd == None):
+        rd = doc.GetActiveRenderData()
     ob = c4d.BaseList2D(c4d.Zmultipass)
     ob.GetDataInstance()[c4d.MULTIPASSOBJECT_TYPE] = c4d.VPBUFFER_OBJECTBUFFER
     ob[c4d.MULTIPASSOBJECT_OBJECTBUFFER] = obid
     rd.InsertMultipass(ob)
-    c4d.EventAdd()
+    core.eventAdd()
 
 def createObjectBuffers(consider_takes=False):
     ''' Parse the scene for all compositing tags with object buffers enabled, then creates them.'''    
     doc = c4d.documents.GetActiveDocument()
-    td = doc.GetTakeData()
-    # clear all existing object buffers
-    clearObjectBuffers()
-    # "simple" mode -- takes are not considered, existing render data is modified
-    if not (consider_takes):
-        _buildObjectBuffers()
-    # "complicated" mode -- creates child RenderData for each take, enabling only object buffers
-    # belonging to visible objects in the take
-    elif (consider_takes):
-        # Operates only on "checked" takes -- those flagged in the scene
-        take_list = core.getCheckedTakes()
-        # if no takes are checked, escape
-        if len(take_list) == 0:
-            return
-        # Get the active render data -- this will be the primary RenderData from which the chilrden
-        # will inherit
-        parent_rdata = doc.GetActiveRenderData()
-        if parent_rdata.GetUp():
-            raise debug.PipelineError(4)
-            return
-        # Create a child renderdata for each take
-        for take in take_list:
-            # Change the take -- this will affect all the necessary visibility flags
-            td.SetCurrentTake(take)
-            # Create the child data
-            child_rdata = core.createChildRenderData(parent_rdata, suffix=take.GetName(), set_active=True)
-            # Set up Object Buffers for the objects visible in the current take
+    # every buffer, child RenderData and take assignment below is one undo step / scene update
+    with core.transaction(doc):
+        td = doc.GetTakeData()
+        # clear all existing object buffers
+        clearObjectBuffers()
+        # "simple" mode -- takes are not considered, existing render data is modified
+        if not (consider_takes):
             _buildObjectBuffers()
-            # Assign the RenderData to the take
-            take.SetRenderData(td, child_rdata)
-            c4d.EventAdd()
-
-def createUtilityPass(take=None):
+        # "complicated" mode -- creates child RenderData for each take, enabling only object buffers
+        # belonging to visible objects in the take
+        elif (consider_takes):
+            # Operates only on "checked" takes -- those flagged in the scene
+            take_list = core.getCheckedTakes()
+            # if no takes are checked, escape
+            if len(take_list) == 0:
+                return
+            # Get the active render data -- this will be the primary RenderData from which the chilrden
+            # will inherit
+            parent_rdata = doc.GetActiveRenderData()
+            if parent_rdata.GetUp():
+                raise debug.PipelineError(4)
+                return
+            # Work out the object buffers of every take at once, from a single pass over the scene and
+            # the takes' own overrides (rather than activating each take in turn)
+            plan = planObjectBuffers(take_list, doc)
+            # Create a child renderdata for each take, with only the object buffers visible in it
+            for take, ids in plan.iteritems():
+                child_rdata = core.createChildRenderData(parent_rdata, suffix=take.GetName())
+                for id_ in ids:
+                    enableObjectBuffer(id_, rd=child_rdata)
+                # Assign the RenderData to the take
+                take.SetRenderData(td, child_rdata)
+            core.eventAdd()
+
+def createUtilityPass(take=None, production=None):
     ''' Create a utility pass version of the passed take. If no take is passed, it will create one
-        for the main take.'''
+        for the main take. The production's utility settings are used (read from the scene's metadata
+        tag if no production is passed.)'''
     doc = c4d.documents.GetActiveDocument()
     td  = doc.GetTakeData()
     parent_rdata = doc.GetActiveRenderData()
@@ -460,37 +543,144 @@ def createUtilityPass(take=None):
     new_take = core.take('{}_util'.format(take.GetName()), set_active=True)
     child_rdata = core.createChildRenderData(parent_rdata, suffix='UTIL', set_active=True)
     new_take.SetRenderData(td, child_rdata)
-    self.clearAllMultipasses()
+    clearAllMultipasses()
 
-    # modify renderdata for 32-bit exr w/ data passes
-    render_data = database.getProduction('DEFAULT')
+    # modify renderdata for 32-bit exr w/ data passes. The resolved production record falls back
+    # to the DEFAULT settings for anything the production doesn't override.
+    if (production == None):
+        production = _getSceneProduction(doc)
+    render_data = database.getProduction(production or 'DEFAULT')
 
     for multipass_id in render_data['passes_util']:
         mp_obj = c4d.BaseList2D(c4d.Zmultipass)
-        mp_obj.GetDataInstance()[c4d.MULTIPASSOBJECT_TYPE] = eval(multipass_id)
+        mp_obj.GetDataInstance()[c4d.MULTIPASSOBJECT_TYPE] = symbols.resolve(multipass_id)
         child_rdata.InsertMultipass(mp_obj)
     for attribute in render_data['image_settings_util']:
-        child_rdata[eval(attribute)] = render_data['image_settings_util'][attribute]
+        child_rdata[symbols.resolve(attribute)] = render_data['image_settings_util'][attribute]
 
     return (take, child_rdata)
 
-def _getObjectBufferIDs():
-    ''' Private. Get a set of all unique Object Buffer ids set in compositing tags in the scene. '''
-    ids = []
-    channel_enable = 'c4d.COMPOSITINGTAG_ENABLECHN{}'
-    channel_id     = 'c4d.COMPOSITINGTAG_IDCHN{}'
-    doc = c4d.documents.GetActiveDocument()
-    td = doc.GetTakeData()
-
-    for obj in core.ObjectIterator(doc.GetFirstObject()):
-        if core.isVisible(obj):
-            for tag in core.TagIterator(obj):
+def _getSceneProduction(doc):
+    ''' Private. Reads the production from a document's metadata tag (without loading the rest of the
+    scene's pipeline data.) Returns None for untagged scenes or unreadable metadata. '''
+    tag = metadata.findTag(doc)
+    if (tag == None):
+        return None
+    try:
+        return metadata.decode(tag[c4d.ANNOTATIONTAG_TEXT])['production']
+    except debug.PipelineError:
+        return None
+
+def _topLevelHook(doc):
+    ''' Private. Whether a document has a __SCENE__ object at the top of its hierarchy (one pass over
+    the top-level objects only.) '''
+    obj = doc.GetFirstObject()
+    while (obj):
+        if (obj.GetName() == '__SCENE__'):
+            return True
+        obj = obj.GetNext()
+    return False
+
+def _getObjectBufferIDs(start=None):
+    ''' Private. Get a set of all unique Object Buffer ids set in compositing tags in the scene (or
+    below the passed object.) '''
+    ids = set()
+    if (start == None):
+        start = c4d.documents.GetActiveDocument().GetFirstObject()
+
+    # a fresh visibility pass, since switching takes changes visibility without rebuilding the index
+    for obj, visible in core.walkVisibility(start):
+        if (visible):
+            for tag in traverse.tags(obj):
                 if tag.GetType() == c4d.Tcompositing:
-                    for i in range(12):
-                        if tag[eval(channel_enable.format(i))] == 1:
-                            id_ = tag[eval(channel_id.format(i))]
-                            ids.append(id_)
-    return sorted(list(set(ids)), reverse=True)
+                    for enable, id_ in symbols.COMPOSITINGTAG_CHANNELS:
+                        if tag[enable] == 1:
+                            ids.add(tag[id_])
+    return sorted(ids, reverse=True)
+
+def planObjectBuffers(takes, doc=None):
+    ''' Works out which object buffers are visible in each of a list of takes, without making any of
+    them the current take. The scene is traversed once; each take's overrides (and those of the takes
+    it inherits from) and override groups are then applied to that snapshot in memory.
+    Returns: OrderedDict of {BaseTake: [object buffer ids]} (ids sorted as by _getObjectBufferIDs) '''
+    if (doc == None):
+        doc = c4d.documents.GetActiveDocument()
+    td       = doc.GetTakeData()
+    channels = symbols.COMPOSITINGTAG_CHANNELS
+    params   = [c4d.COMPOSITINGTAG_MATTEOBJECT, c4d.COMPOSITINGTAG_SEENBYCAMERA]
+    for enable, id_ in channels:
+        params.extend([enable, id_])
+
+    # one pass over the scene: each object's parent (as an index), render mode & compositing tags
+    records = []
+    tag_values = {}
+    index   = {}
+    for obj, parent, depth in traverse.walk(doc.GetFirstObject()):
+        comp_tags = []
+        for tag in traverse.tags(obj):
+            if tag.GetType() == c4d.Tcompositing:
+                comp_tags.append(tag)
+                tag_values[tag] = dict((p, tag[p]) for p in params)
+        index[obj] = len(records)
+        records.append((obj, index.get(parent, -1), obj.GetRenderMode(), comp_tags))
+
+    plan = collections.OrderedDict()
+    for take in takes:
+        modes, tags, groups = _takeOverrides(take, td, tag_values, params)
+        visible = []
+        ids     = set()
+        for obj, parent, mode, comp_tags in records:
+            mode   = modes.get(obj, mode)
+            states = [tags.get(tag, tag_values[tag]) for tag in comp_tags]
+            # override groups are applied last: a group's compositing tag replaces the object's own
+            # (the group of the most specific take winning), as it does when rendering
+            for group_mode, group_state in groups.get(obj, []):
+                if not (group_mode == c4d.MODE_UNDEF):
+                    mode = group_mode
+                if (group_state):
+                    states = [group_state]
+            # an object is visible if it and all of its parents are
+            is_visible = not (mode == c4d.MODE_OFF) and ((parent == -1) or visible[parent])
+            for state in states:
+                if (state[c4d.COMPOSITINGTAG_MATTEOBJECT] == 1) or (state[c4d.COMPOSITINGTAG_SEENBYCAMERA] == 0):
+                    is_visible = False
+            visible.append(is_visible)
+            if (is_visible):
+                for state in states:
+                    for enable, id_ in channels:
+                        if state[enable] == 1:
+                            ids.add(state[id_])
+        plan[take] = sorted(ids, reverse=True)
+    return plan
+
+def _takeOverrides(take, td, tag_values, params):
+    ''' Private. Collects the overrides that apply in a take: its own, and those of every take above
+    it (applied from the main take down, so override groups are listed least specific first.)
+    Returns: ({object: render mode}, {compositing tag: {param: value}},
+              {object: [(override group render mode, override group compositing tag values)]}) '''
+    chain = []
+    while (take):
+        chain.insert(0, take)
+        take = take.GetUp()
+
+    modes, tags, groups = {}, {}, {}
+    for take in chain:
+        for ov in take.GetOverrides():
+            node = ov.GetSceneNode()
+            for desc_id in ov.GetAllOverrideDescID():
+                param = desc_id[0].id
+                if (param == c4d.ID_BASEOBJECT_VISIBILITY_RENDER) and isinstance(node, c4d.BaseObject):
+                    modes[node] = ov[desc_id]
+                elif (node in tag_values) and (param in params):
+                    if not (node in tags):
+                        tags[node] = dict(tag_values[node])
+                    tags[node][param] = ov[desc_id]
+        for og in take.GetOverrideGroups():
+            group_tag   = og.FindTag(c4d.Tcompositing)
+            group_state = dict((p, group_tag[p]) for p in params) if (group_tag) else None
+            for obj in og.GetObjectsInGroup():
+                groups.setdefault(obj, []).append((og.GetRenderMode(), group_state))
+    return (modes, tags, groups)
 
 def _buildObjectBuffers():
     ''' Private. '''
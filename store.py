@@ -0,0 +1,280 @@
+# coding: UTF-8
+
+# Content-addressed file store for ESPN Animation projects pipeline
+#    - Every file added to the store is kept once, under its hash, and materialized into the
+#      production folders (assets/TEXTURES, team tex folders) as a hard link, symbolic link or copy.
+#    - File hashes are kept in a persistent cache keyed by (path, size, mtime), so a file is only
+#      read again once it has changed.
+#    - Store objects are made read-only. Files are materialized as copies unless a link mode is asked
+#      for explicitly: a hard link shares its contents (and read-only flag) with the stored object, so
+#      a linked texture can't be edited in place -- it has to be saved as a new file.
+
+import marshal
+import os
+import os.path
+import stat
+import threading
+# custom libraries
+from espntools import database
+from espntools import debug
+from espntools import filesystem
+
+ALGORITHM = 'md5'
+
+# HASH CACHE ######################################################################################
+class HashCache(object):
+    ''' A persistent cache of file hashes, keyed by path and validated against the file's size and
+    mtime. Safe to use from many threads. '''
+    VERSION = 1
+
+    def __init__(self, path=None):
+        self._path   = path
+        self._hashes = {}
+        self._lock   = threading.Lock()
+        self._dirty  = False
+        self.hits    = 0
+        self.misses  = 0
+        self.load()
+
+    @property
+    def path(self):
+        return self._path or database.__hashdb__
+
+    def header(self):
+        return (self.VERSION, ALGORITHM, marshal.version)
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            with open(self.path, 'rb') as stream:
+                header, hashes = marshal.load(stream)
+        except (EOFError, ValueError, TypeError, IOError):
+            debug.warning('Hash cache is unreadable, rebuilding', self.path)
+            return False
+        if (header == self.header()):
+            with self._lock:
+                self._hashes = hashes
+        return True
+
+    def save(self):
+        ''' Persists the cache (if anything changed), through a temporary file and a rename. '''
+        with self._lock:
+            if not (self._dirty):
+                return False
+            hashes, self._dirty = dict(self._hashes), False
+        temp_path = filesystem.tempPath(self.path)
+        try:
+            with open(temp_path, 'wb') as stream:
+                marshal.dump((self.header(), hashes), stream)
+            filesystem.replace(temp_path, self.path)
+        except (IOError, OSError):
+            debug.warning('Could not save hash cache', self.path)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        return True
+
+    def get(self, path):
+        ''' Returns (hex digest, size) for a file, hashing it only if it's new or has changed. '''
+        info = os.stat(path)
+        key  = os.path.normcase(os.path.abspath(path))
+        with self._lock:
+            entry = self._hashes.get(key)
+            if (entry) and (entry[0] == info.st_size) and (entry[1] == info.st_mtime):
+                self.hits += 1
+                return (entry[2], entry[0])
+            self.misses += 1
+        digest = filesystem.hashFile(path, ALGORITHM)
+        with self._lock:
+            self._hashes[key] = (info.st_size, info.st_mtime, digest)
+            self._dirty = True
+        return (digest, info.st_size)
+
+    def put(self, path, digest):
+        ''' Records a digest that's already known (e.g. computed while copying the file.) '''
+        info = os.stat(path)
+        with self._lock:
+            self._hashes[os.path.normcase(os.path.abspath(path))] = (info.st_size, info.st_mtime, digest)
+            self._dirty = True
+
+# INDEXING ########################################################################################
+def listFiles( folders ):
+    ''' Returns every file path below a list of folders (one listing per folder.) '''
+    files = []
+    stack = list(folders)
+    while (stack):
+        folder = stack.pop()
+        try:
+            entries = filesystem.listDir(folder)
+        except OSError:
+            continue
+        for name, is_dir in entries:
+            if (is_dir):
+                stack.append(os.path.join(folder, name))
+            else:
+                files.append(os.path.join(folder, name))
+    return sorted(files)
+
+def index( paths, hashes=None, workers=4 ):
+    ''' Hashes a list of files on a thread pool (through the hash cache.)
+    Returns: {path: (hex digest, size)}; files that can't be read are left out. '''
+    if (hashes == None):
+        hashes = getHashCache()
+
+    def hashPath(path):
+        try:
+            return hashes.get(path)
+        except (IOError, OSError):
+            debug.warning('Could not hash file', path)
+            return None
+
+    results = filesystem.parallel(hashPath, paths, workers=workers)
+    hashes.save()
+    return dict((path, result) for path, result in zip(paths, results) if (result))
+
+def report( folders, hashes=None, workers=4 ):
+    ''' Finds the byte-identical files below a list of folders. Files that are already links to the
+    same data (see filesystem.fileId) are only counted once.
+    Returns: {'files': int, 'bytes': int, 'duplicates': {digest: [paths]}, 'reclaimable': int} '''
+    indexed    = index(listFiles(folders), hashes=hashes, workers=workers)
+    by_digest  = {}
+    total      = 0
+    for path, (digest, size) in indexed.iteritems():
+        total += size
+        by_digest.setdefault(digest, []).append(path)
+
+    duplicates  = {}
+    reclaimable = 0
+    for digest, paths in by_digest.iteritems():
+        if (len(paths) < 2):
+            continue
+        file_ids = set()
+        for path in paths[:]:
+            try:
+                file_ids.add(filesystem.fileId(path))
+            except OSError:
+                # removed (or made unreadable) since it was indexed
+                debug.warning('Could not stat file', path)
+                paths.remove(path)
+        if (len(file_ids) > 1):
+            duplicates[digest] = sorted(paths)
+            reclaimable += indexed[paths[0]][1] * (len(file_ids) - 1)
+    return {
+        'files': len(indexed),
+        'bytes': total,
+        'duplicates': duplicates,
+        'reclaimable': reclaimable
+        }
+
+# STORE ###########################################################################################
+class ContentStore(object):
+    ''' A folder of files named by their hash: <root>/<first 2 hex digits>/<digest><extension>. '''
+    def __init__(self, root=None, hashes=None, mode='copy'):
+        self.root   = root or database.__storeroot__
+        self.hashes = hashes or getHashCache()
+        self.mode   = mode
+
+    def objectPath(self, digest, ext=''):
+        return os.path.join(self.root, digest[:2], digest + ext.lower())
+
+    def add(self, path):
+        ''' Adds a file to the store (if its contents aren't already there.)
+        Returns: (path of the stored object, hex digest, size) '''
+        digest, size = self.hashes.get(path)
+        obj_path     = self.objectPath(digest, os.path.splitext(path)[1])
+        if not os.path.isfile(obj_path):
+            if not os.path.isdir(os.path.dirname(obj_path)):
+                try:
+                    os.makedirs(os.path.dirname(obj_path))
+                except OSError:
+                    # another worker may have made it first
+                    if not os.path.isdir(os.path.dirname(obj_path)):
+                        raise
+            stored, size = filesystem.copyAtomic(path, obj_path, ALGORITHM)
+            if not (stored == digest):
+                raise IOError('{0} changed while it was added to the store'.format(path))
+            # stored objects are never edited (nor are the files hard-linked to them)
+            os.chmod(obj_path, stat.S_IREAD | stat.S_IRGRP | stat.S_IROTH)
+            self.hashes.put(obj_path, digest)
+        return (obj_path, digest, size)
+
+    def materialize(self, path, dst, mode=None):
+        ''' Adds a file to the store, and links (or copies) the stored object to dst. If dst already is
+        a link to the stored object, it's left alone (mode 'existing'.)
+        Returns: (mode used, hex digest, size) '''
+        obj_path, digest, size = self.add(path)
+        protect = None
+        if os.path.exists(dst):
+            if (self._isLinked(dst, obj_path)):
+                return ('existing', digest, size)
+            if not os.access(dst, os.W_OK):
+                # Windows won't replace a read-only file. If dst is a link to another stored object,
+                # clearing the flag clears it on that object too, so it's made read-only again below.
+                protect = self._linkedObject(dst)
+                filesystem.makeWritable(dst)
+        try:
+            used = filesystem.link(obj_path, dst, mode or self.mode)
+        finally:
+            if (protect):
+                os.chmod(protect, stat.S_IREAD | stat.S_IRGRP | stat.S_IROTH)
+        if (used == 'copy'):
+            # copies are independent of the store, and editable like any other texture
+            os.chmod(dst, stat.S_IREAD | stat.S_IWRITE | stat.S_IRGRP | stat.S_IROTH)
+        self.hashes.put(dst, digest)
+        return (used, digest, size)
+
+    def _isLinked(self, path, obj_path):
+        ''' Private. True if path is a (hard or symbolic) link to a stored object. '''
+        try:
+            return filesystem.fileId(path) == filesystem.fileId(obj_path)
+        except OSError:
+            return False
+
+    def _linkedObject(self, path):
+        ''' Private. Returns the stored object that path is a link to, or None. '''
+        try:
+            digest, size = self.hashes.get(path)
+        except (IOError, OSError):
+            return None
+        obj_path = self.objectPath(digest, os.path.splitext(path)[1])
+        if os.path.isfile(obj_path) and self._isLinked(path, obj_path):
+            return obj_path
+        return None
+
+    def dedupe(self, folders, dry_run=True, workers=4, mode='hardlink'):
+        ''' Replaces byte-identical files below a list of folders with links to one stored object (the
+        linked files become read-only.) With dry_run, only reports. Files that can't be replaced are
+        skipped with a warning, and listed in the report under 'failed'. Returns the report (see
+        store.report.) '''
+        result = report(folders, hashes=self.hashes, workers=workers)
+        result['failed'] = []
+        if not (dry_run):
+            for digest, paths in result['duplicates'].iteritems():
+                for path in paths:
+                    try:
+                        self.materialize(path, path, mode=mode)
+                    except (IOError, OSError) as e:
+                        debug.warning('Could not dedupe file', '{0} ({1})'.format(path, e))
+                        result['failed'].append(path)
+            self.hashes.save()
+        debug.info('Reclaimable space in texture folders', '{0:.1f} MB ({1} duplicated files)'.format(
+            result['reclaimable'] / (1024.0 * 1024.0), len(result['duplicates'])))
+        return result
+
+_hashes = None
+_hash_lock = threading.Lock()
+
+def getHashCache():
+    ''' Gets the shared (persistent) hash cache. '''
+    global _hashes
+    with _hash_lock:
+        if (_hashes == None):
+            _hashes = HashCache()
+        return _hashes
+
+def getStore( mode='copy' ):
+    ''' Gets the production store, or None if the store folder isn't available. '''
+    if not os.path.isdir(database.__storeroot__):
+        return None
+    return ContentStore(mode=mode)
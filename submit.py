@@ -17,16 +17,15 @@ from random import uniform
 from c4d import gui
 
 from espntools import core
+from espntools import paths
 
 # Default submission settings
 default_priority = 5000
 instances = 10
 max_cpus = 50
 
-# Localization variables for each ESPN render farm
-mapped_drives = ['Y:', 'W:']
+# Localization variables for each ESPN render farm (mapped drives -> UNC: see database.__uncroots__)
 local_drives = ['C:', 'V:']
-nas_unc = '\\\\cagenas'
 
 # Unique id numbers for each of the GUI elements - DO NOT CHANGE
 LBL_JOB_NAME =      1000
@@ -237,7 +236,9 @@ class SubmissionDialog(gui.GeDialog):
       self.save_main_bool = rd[c4d.RDATA_SAVEIMAGE]
       self.save_multi_bool = rd[c4d.RDATA_MULTIPASS_SAVEIMAGE]
 
-      # Get output paths.
+      # Get output paths. These are read back from the render settings rather than built from the
+      # scene's path templates (see paths.PathContext): the pipeline has already written the
+      # templated paths there, and any change the artist has made since must be what's rendered.
       output_path = {True:rd[c4d.RDATA_PATH], False:""}[self.save_main_bool]
       output_multi_path = {True:rd[c4d.RDATA_MULTIPASS_FILENAME], False:""}[self.save_multi_bool]
 
@@ -266,10 +267,9 @@ class SubmissionDialog(gui.GeDialog):
 
     # FORMATTING / CLEANUP / DEPENDENT FLAGS
     # Pathing everything to \\cagenas from Y/W:
-    for letter in mapped_drives:
-      scene_path = scene_path.replace(letter, nas_unc)
-      output_path = output_path.replace(letter, nas_unc)
-      output_multi_path = output_multi_path.replace(letter, nas_unc)
+    scene_path = paths.toUNC(scene_path)
+    output_path = paths.toUNC(output_path)
+    output_multi_path = paths.toUNC(output_multi_path)
 
     # Dealing with threads
     if self.GetBool(BOOL_ALL_THREADS):
@@ -0,0 +1,49 @@
+# coding: UTF-8
+
+# c4d symbol tables for ESPN Animation projects pipeline
+#    - Resolves c4d constant names (as stored in the databases, e.g. "c4d.VPBUFFER_DEPTH") to their
+#      values once, at import, instead of eval()ing the names every time they're used.
+#    - Also keeps the reverse index (value -> names) for lookups while debugging.
+#    - Like core, this has no dependencies besides Maxon's c4d module.
+
+import c4d
+
+# {name: value} of every integer constant in the c4d module
+CONSTANTS = dict((k, v) for k, v in c4d.__dict__.iteritems()
+                 if isinstance(v, (int, long)) and not isinstance(v, bool) and not k.startswith('_'))
+
+# {value: [names]}
+REVERSE = {}
+for _name, _value in CONSTANTS.iteritems():
+    REVERSE.setdefault(_value, []).append(_name)
+for _names in REVERSE.itervalues():
+    _names.sort()
+
+def resolve( name ):
+    ''' Returns the value of a c4d constant, by name ('c4d.NAME' or 'NAME'). Integers are passed
+    through, so database values may be stored either way. Raises KeyError for unknown names. '''
+    if isinstance(name, (int, long)):
+        return name
+    if name.startswith('c4d.'):
+        name = name[4:]
+    try:
+        return CONSTANTS[name]
+    except KeyError:
+        # constants that aren't in the module dictionary (e.g. registered by plug-ins later on)
+        value = getattr(c4d, name, None)
+        if not isinstance(value, (int, long)):
+            raise KeyError('Unknown c4d constant: {0}'.format(name))
+        CONSTANTS[name] = value
+        REVERSE.setdefault(value, []).append(name)
+        return value
+
+def names( value, prefix='' ):
+    ''' Returns the names of every c4d constant with a value (optionally only those starting with a
+    prefix, e.g. 'MSG_'.) '''
+    return [name for name in REVERSE.get(value, []) if name.startswith(prefix)]
+
+# The (enable, id) parameters of the 12 object buffer channels of a compositing tag
+COMPOSITINGTAG_CHANNELS = [
+    (resolve('COMPOSITINGTAG_ENABLECHN{0}'.format(i)), resolve('COMPOSITINGTAG_IDCHN{0}'.format(i)))
+    for i in range(12)
+    ]
@@ -0,0 +1,345 @@
+# coding: UTF-8
+
+# Texture scanning for ESPN Animation projects pipeline
+#    - Walks the full shader tree of every material in a document (including bitmaps nested inside
+#      layer, fusion and filter shaders) and yields a compact record for every bitmap reference.
+#    - Each unique raw path is resolved against the document (c4d.GenerateTexturePath) only once
+#      per scan.
+#    - The texture repository indexes the production's texture folders from one recursive listing,
+#      so texture lookups are made in memory instead of with a stat per texture on the NAS.
+#    - Texture migration copies on a pool of worker threads, skipping textures that are already
+#      in place and verifying every copy.
+#    - Like core, this depends only on Maxon's c4d module and the dependency-free helpers.
+
+import collections
+import marshal
+import os
+import os.path
+import tempfile
+import threading
+import time
+# internal libraries
+import c4d
+# custom libraries
+from espntools import debug
+from espntools import filesystem
+from espntools import traverse
+
+# The standard material channels where textures may be found
+CHANNELS = [
+    c4d.MATERIAL_COLOR_SHADER,
+    c4d.MATERIAL_DIFFUSION_SHADER,
+    c4d.MATERIAL_LUMINANCE_SHADER,
+    c4d.MATERIAL_TRANSPARENCY_SHADER,
+    c4d.MATERIAL_REFLECTION_SHADER,
+    c4d.MATERIAL_ENVIRONMENT_SHADER,
+    c4d.MATERIAL_BUMP_SHADER,
+    c4d.MATERIAL_ALPHA_SHADER,
+    c4d.MATERIAL_SPECULAR_SHADER,
+    c4d.MATERIAL_DISPLACEMENT_SHADER,
+    c4d.MATERIAL_NORMAL_SHADER
+    ]
+# Channel reported for the new-style reflection layers, and for shaders not linked to a known channel
+REFLECTION = 'refl'
+
+# material (BaseMaterial), shader (BaseShader), channel (int, 'refl' or None), raw (str: as stored
+# in the shader), path (str: resolved path, or None if c4d can't find the file)
+TextureRef = collections.namedtuple('TextureRef', ['material', 'shader', 'channel', 'raw', 'path'])
+
+class PathResolver(object):
+    ''' Memoizes c4d.GenerateTexturePath for one document: each unique raw path is looked up once. '''
+    def __init__(self, doc):
+        self.doc_path = doc.GetDocumentPath() if (doc) else ''
+        self._cache   = {}
+
+    def __call__(self, raw):
+        try:
+            return self._cache[raw]
+        except KeyError:
+            path = c4d.GenerateTexturePath(self.doc_path, raw, '') or None
+            self._cache[raw] = path
+            return path
+
+def _channelRoots( mat ):
+    ''' Private. Returns a list of (channel, root shader) linked from a material's channels. '''
+    roots = []
+    if (mat.GetType() == c4d.Mmaterial):
+        for channel in CHANNELS:
+            shd = mat[channel]
+            if (shd):
+                roots.append((channel, shd))
+        for shd in mat.GetAllReflectionShaders():
+            roots.append((REFLECTION, shd))
+    return roots
+
+def scan( doc=None, resolver=None ):
+    ''' Yields a TextureRef for every bitmap shader in every material of a document. Shaders linked
+    from a material channel are reported with that channel; any other shader owned by the material
+    (e.g. from a third-party material) is reported with a channel of None. '''
+    if (doc == None):
+        doc = c4d.documents.GetActiveDocument()
+    if (resolver == None):
+        resolver = PathResolver(doc)
+    for mat in traverse.materials(doc):
+        seen = set() # C4DAtom hashes on the underlying shader, like its ==
+        # shaders reachable from a known channel first, so they're reported with that channel
+        for channel, root in _channelRoots(mat):
+            for shd in traverse.objects(root, siblings=False):
+                if (shd in seen):
+                    continue
+                seen.add(shd)
+                ref = _bitmap(mat, shd, channel, resolver)
+                if (ref):
+                    yield ref
+        # then everything else the material owns
+        for shd in traverse.objects(mat.GetFirstShader()):
+            if (shd in seen):
+                continue
+            ref = _bitmap(mat, shd, None, resolver)
+            if (ref):
+                yield ref
+
+def _bitmap( mat, shd, channel, resolver ):
+    ''' Private. Returns a TextureRef if the shader is a bitmap with a path set. '''
+    if not (shd.GetType() == c4d.Xbitmap):
+        return
+    raw = shd[c4d.BITMAPSHADER_FILENAME]
+    if not (raw):
+        return
+    return TextureRef(mat, shd, channel, raw, resolver(raw))
+
+def summary( refs=None ):
+    ''' Groups texture references by path (the resolved path, or the raw path if unresolved.)
+    Returns: {path: [TextureRef]}, in the order each path was first found. '''
+    if (refs == None):
+        refs = scan()
+    grouped = collections.OrderedDict()
+    for ref in refs:
+        grouped.setdefault(ref.path or ref.raw, []).append(ref)
+    return grouped
+
+def missing( refs=None ):
+    ''' Returns {raw path: [TextureRef]} for every texture c4d can't resolve to a file. '''
+    if (refs == None):
+        refs = scan()
+    grouped = collections.OrderedDict()
+    for ref in refs:
+        if (ref.path == None):
+            grouped.setdefault(ref.raw, []).append(ref)
+    return grouped
+
+# TEXTURE REPOSITORY ##############################################################################
+class TextureRepository(object):
+    ''' An index of every file below a set of texture folders.
+    roots (dict): {key: folder}, e.g. {None: production TEXTURES folder, 'BOS': team tex folder}
+    cache (str): optional sidecar file the index is persisted to.
+    Each folder's listing is stored with the folder's mtime. A refresh stats every known folder, and
+    only lists the ones that have changed since they were last indexed. '''
+    VERSION = 1
+
+    def __init__(self, roots, cache=None):
+        self.roots  = dict(roots)
+        self.cache  = cache
+        self.listed = 0
+        self._dirs  = {}
+        self._names = {}
+        self._lock  = threading.Lock()
+        self.load()
+
+    def header(self):
+        return (self.VERSION, marshal.version, sorted(self.roots.items()))
+
+    def load(self):
+        ''' Loads the persisted index, if there is one for the same set of roots. '''
+        if not (self.cache) or not os.path.isfile(self.cache):
+            return False
+        try:
+            with open(self.cache, 'rb') as stream:
+                header, dirs = marshal.load(stream)
+        except (EOFError, ValueError, TypeError, IOError):
+            debug.warning('Texture index is unreadable, rebuilding', self.cache)
+            return False
+        if not (header == self.header()):
+            return False
+        with self._lock:
+            self._dirs = dirs
+            self._build()
+        return True
+
+    def save(self):
+        ''' Persists the index. Written to a temporary file and renamed, so that other readers never
+        see a partial index. '''
+        if not (self.cache):
+            return False
+        # a unique temporary file, since every artist's session may be saving the same index
+        temp_path = None
+        try:
+            handle, temp_path = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(self.cache) + '.',
+                                                 dir=os.path.dirname(self.cache) or None)
+            with self._lock:
+                with os.fdopen(handle, 'wb') as stream:
+                    marshal.dump((self.header(), self._dirs), stream)
+            filesystem.replace(temp_path, self.cache)
+        except (IOError, OSError):
+            debug.warning('Could not save texture index', self.cache)
+            if (temp_path) and os.path.exists(temp_path):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            return False
+        return True
+
+    def refresh(self):
+        ''' Brings the index up to date with the folders on disk. Returns the number of folders that
+        had to be listed again (0 if nothing changed.) '''
+        with self._lock:
+            dirs   = {}
+            listed = 0
+            for root in self.roots.itervalues():
+                listed += self._scan(root, dirs)
+            changed = (listed > 0) or not (len(dirs) == len(self._dirs))
+            self._dirs   = dirs
+            self.listed += listed
+            if (changed):
+                self._build()
+        if (changed):
+            self.save()
+        return listed
+
+    def _scan(self, folder, dirs):
+        ''' Private. Indexes a folder and its subfolders into dirs, re-using unchanged listings. '''
+        mtime = filesystem.getMtime(folder)
+        if (mtime == None):
+            return 0
+        listed = 0
+        entry  = self._dirs.get(folder)
+        if (entry == None) or not (entry[0] == mtime):
+            try:
+                entries = filesystem.listDir(folder)
+            except OSError:
+                return 0
+            files   = sorted(name for name, is_dir in entries if not is_dir)
+            subdirs = sorted(name for name, is_dir in entries if is_dir)
+            entry   = (mtime, files, subdirs)
+            listed  = 1
+        dirs[folder] = entry
+        for name in entry[2]:
+            listed += self._scan(os.path.join(folder, name), dirs)
+        return listed
+
+    def _build(self):
+        ''' Private. Rebuilds the {root key: {file name: path}} lookup. A file directly in a root folder
+        wins over a file of the same name in one of its subfolders. '''
+        names = {}
+        for key, root in self.roots.iteritems():
+            lookup = {}
+            prefix = os.path.join(root, '')
+            for folder in sorted(self._dirs, reverse=True):
+                if not (folder == root) and not folder.startswith(prefix):
+                    continue
+                for name in self._dirs[folder][1]:
+                    lookup[os.path.normcase(name)] = os.path.join(folder, name)
+            names[key] = lookup
+        self._names = names
+
+    def find(self, name, key=None):
+        ''' Returns the path of a texture in the folder registered under key, or None. '''
+        lookup = self._names.get(key)
+        if (lookup == None):
+            return None
+        return lookup.get(os.path.normcase(os.path.basename(name)))
+
+    def files(self, key=None):
+        ''' Returns every indexed file path under a root. '''
+        return sorted(self._names.get(key, {}).itervalues())
+
+_repositories = {}
+_repository_lock = threading.Lock()
+
+def getRepository( name, roots, cache=None, ttl=30.0 ):
+    ''' Gets the (cached) texture repository registered under a name (e.g. a production), refreshing
+    it if it hasn't been refreshed within ttl seconds. '''
+    with _repository_lock:
+        entry = _repositories.get(name)
+        if (entry == None) or not (entry[1].roots == roots) or not (entry[1].cache == cache):
+            entry = [0.0, TextureRepository(roots, cache=cache)]
+            _repositories[name] = entry
+    if (time.time() - entry[0] >= ttl):
+        entry[1].refresh()
+        entry[0] = time.time()
+    return entry[1]
+
+def invalidateRepository( name=None ):
+    ''' Forces the next getRepository call to refresh a repository (or all of them.) The refresh is
+    still incremental. '''
+    with _repository_lock:
+        for key, entry in _repositories.iteritems():
+            if (name == None) or (key == name):
+                entry[0] = 0.0
+
+# MIGRATION #######################################################################################
+class MigrationResult(collections.namedtuple('MigrationResult',
+        ['src', 'dst', 'status', 'size', 'seconds', 'error'])):
+    ''' The outcome of migrating one texture. status is one of 'copied', 'linked' (materialized from
+    the content store), 'skipped' (an identical file was already at the destination) or 'failed'. '''
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return not (self.status == 'failed')
+
+    @property
+    def throughput(self):
+        ''' Megabytes per second (0.0 if nothing was copied.) '''
+        if (self.status == 'copied') and (self.seconds > 0):
+            return self.size / (1024.0 * 1024.0) / self.seconds
+        return 0.0
+
+def migrateFile( job, store=None ):
+    ''' Migrates one (source path, destination folder) job. Safe to call from any thread. With a
+    content store (see store.ContentStore), the texture is added to the store and linked into the
+    destination folder instead of being copied there. '''
+    src, dst_dir = job
+    dst   = os.path.join(dst_dir, os.path.basename(src))
+    start = time.time()
+    try:
+        if filesystem.sameFile(src, dst):
+            return MigrationResult(src, dst, 'skipped', os.path.getsize(dst), time.time() - start, None)
+        if (store):
+            mode, digest, size = store.materialize(src, dst)
+            status = 'copied' if (mode == 'copy') else 'linked'
+            return MigrationResult(src, dst, status, size, time.time() - start, None)
+        digest, size = filesystem.copyAtomic(src, dst)
+        return MigrationResult(src, dst, 'copied', size, time.time() - start, None)
+    except (IOError, OSError) as e:
+        return MigrationResult(src, dst, 'failed', 0, time.time() - start, e)
+
+def migrate( jobs, workers=4, progress=None, store=None ):
+    ''' Migrates a list of (source path, destination folder) jobs on a bounded thread pool.
+    progress(done, total, result) is called on the calling thread as each texture finishes, so it
+    may update the UI. Returns a list of MigrationResult, in the order of jobs. '''
+    jobs  = list(jobs)
+    count = [0]
+
+    def finished(job, result):
+        count[0] += 1
+        if (result.status == 'copied'):
+            debug.info('Migrated texture', '{0} -> {1} ({2:.1f} MB/s)'.format(
+                result.src, result.dst, result.throughput))
+        elif (result.status == 'linked'):
+            debug.info('Linked texture from store', '{0} -> {1}'.format(result.src, result.dst))
+        elif (result.status == 'skipped'):
+            debug.info('Texture already migrated', result.dst)
+        else:
+            debug.warning('Could not migrate texture', '{0} ({1})'.format(result.src, result.error))
+        if (progress):
+            progress(count[0], len(jobs), result)
+
+    def run(job):
+        return migrateFile(job, store=store)
+
+    results = filesystem.parallel(run, jobs, workers=workers, callback=finished)
+    if (store):
+        store.hashes.save()
+    return results
@@ -0,0 +1,77 @@
+# coding: UTF-8
+
+# Scene traversal for ESPN Animation projects pipeline
+#    - Generator-based replacements for core.ObjectIterator / TagIterator / MaterialIterator. They
+#      walk anything with the GetDown / GetNext / GetFirstTag interface of c4d.BaseList2D, and have
+#      no dependencies of their own.
+#    - Objects are walked depth-first, starting object first, then its children, then its siblings
+#      (the same order as core.ObjectIterator.)
+
+class Walk(object):
+    ''' A depth-first walk of a hierarchy, yielding (object, parent, depth) tuples.
+    prune (callable): called with each object; returning True skips that object and its subtree.
+    siblings (bool): also walk the siblings following the starting object.
+    The walk's state lives in __slots__ and the generator's locals, so it costs no per-node
+    allocations beyond the yielded tuple. '''
+    __slots__ = ('start', 'prune', 'siblings')
+
+    def __init__(self, start, prune=None, siblings=True):
+        self.start    = start
+        self.prune    = prune
+        self.siblings = siblings
+
+    def __iter__(self):
+        prune = self.prune
+        obj   = self.start
+        if (obj == None):
+            return
+        parent= obj.GetUp()
+        depth = 0
+        stack = []
+        while True:
+            if (prune == None) or not prune(obj):
+                yield (obj, parent, depth)
+                child = obj.GetDown()
+                if (child):
+                    stack.append((obj.GetNext() if (self.siblings or depth) else None, parent, depth))
+                    obj, parent, depth = child, obj, depth + 1
+                    continue
+            obj = obj.GetNext() if (self.siblings or depth) else None
+            # climb back up until there's a sibling left to visit
+            while (obj == None):
+                if not (stack):
+                    return
+                obj, parent, depth = stack.pop()
+
+def walk( start, prune=None, siblings=True ):
+    ''' Yields (object, parent, depth) for every object below (and after) the start object. '''
+    return iter(Walk(start, prune, siblings))
+
+def objects( start, prune=None, siblings=True ):
+    ''' Yields every object below (and after) the start object. '''
+    for obj, parent, depth in Walk(start, prune, siblings):
+        yield obj
+
+def tags( obj ):
+    ''' Yields every tag on an object. '''
+    tag = obj.GetFirstTag() if (obj) else None
+    while (tag):
+        yield tag
+        tag = tag.GetNext()
+
+def objectsWithTags( start, prune=None, siblings=True ):
+    ''' A fused object + tag walk. Yields (object, parent, depth, [tags]) for every object. '''
+    for obj, parent, depth in Walk(start, prune, siblings):
+        obj_tags = []
+        tag = obj.GetFirstTag()
+        while (tag):
+            obj_tags.append(tag)
+            tag = tag.GetNext()
+        yield (obj, parent, depth, obj_tags)
+
+def materials( doc ):
+    ''' Yields every material in a document. '''
+    mat = doc.GetFirstMaterial() if (doc) else None
+    while (mat):
+        yield mat
+        mat = mat.GetNext()